@@ -0,0 +1,164 @@
+"""
+per-directory totals over everything below a directory: file and directory
+counts, depth, and bytes per extension / MIME category
+
+aggregates(t) computes them bottom-up in one pass, after a scan. results are
+cached on directories that have at least STATS_MIN_ENTRIES entries below
+them (and on t): small directories are cheaper to recount on the rare query
+that reaches them than to keep a histogram for. so once the root has been
+aggregated, a query anywhere costs at most a walk of a few small subtrees.
+
+for the columnar store, the root's stats come straight from its arrays,
+and stats are cached on the ColumnarTree (any entry, as it costs a walk
+through facade objects to compute them otherwise).
+
+tree edits must drop the cached stats of every ancestor of the edited node,
+see invalidate_stats. rescans do this themselves.
+
+files here are all non-directory entries (symlinks and special files too),
+matching the filter in the tk renderer.
+"""
+import bisect
+import functools
+import mimetypes
+import os
+
+from scan import DIRECTORY, KIND_CODES, DirectoryNode
+
+
+STATS_MIN_ENTRIES = 256
+
+
+class DirStats(object):
+    __slots__ = ('files', 'dirs', 'depth', 'extensions')
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        # levels below the directory: 0 when empty, 1 with only files
+        self.depth = 0
+        # extension (see extension()) -> (file count, bytes)
+        self.extensions = {}
+
+    def categories(self):
+        """MIME category ('text', 'image', ...) -> (file count, bytes)"""
+        out = {}
+        for ext, (n, size) in self.extensions.items():
+            category = _category(ext)
+            if category is None:
+                continue
+            c = out.get(category)
+            out[category] = (n, size) if c is None else (c[0] + n, c[1] + size)
+        return out
+
+    def __repr__(self):
+        return '<DirStats %d files, %d dirs, depth %d, %d extensions>' % (
+            self.files, self.dirs, self.depth, len(self.extensions))
+
+
+_EMPTY = DirStats()
+
+
+def extension(name):
+    """
+    last extension of name including the dot, '' for none. compression
+    suffixes keep the extension before them ('.tar.gz'), as mimetypes does.
+    """
+    i = name.rfind('.')
+    if i < 0:
+        return ''
+    if name[i:] in mimetypes.encodings_map:
+        j = name.rfind('.', 0, i)
+        if j >= 0:
+            return name[j:]
+    return name[i:]
+
+
+@functools.lru_cache(maxsize=None)
+def _category(ext):
+    mime_type, _ = mimetypes.guess_type('x' + ext)
+    if mime_type is None:
+        return None
+    return mime_type.split('/')[0]
+
+
+def aggregates(t):
+    """DirStats for the directory t, see module docstring"""
+    if t.stats is not None:
+        return t.stats
+    if _is_columnar(t) and t.index == 0:
+        t.stats = _columnar_aggregate(t.tree)
+        return t.stats
+    # directories still missing stats, parents before children
+    order = []
+    stack = [t]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        for c in node.children:
+            if c.children and c.stats is None:
+                stack.append(c)
+
+    # stats for uncached directories, until their parent has used them
+    computed = {}
+    for node in reversed(order):
+        s = _aggregate(node, computed)
+        if ((isinstance(node, DirectoryNode) or _is_columnar(node)) and
+                (node is t or s.files + s.dirs >= STATS_MIN_ENTRIES)):
+            node.stats = s
+        else:
+            computed[node] = s
+    return s
+
+
+def _aggregate(t, computed):
+    s = DirStats()
+    extensions = s.extensions
+    for c in t.children:
+        if c.children or c.kind == DIRECTORY:
+            cs = c.stats or computed.pop(c, None) or _EMPTY
+            s.files += cs.files
+            s.dirs += cs.dirs + 1
+            if cs.depth + 1 > s.depth:
+                s.depth = cs.depth + 1
+            for ext, (n, size) in cs.extensions.items():
+                e = extensions.get(ext)
+                extensions[ext] = (n, size) if e is None else (e[0] + n, e[1] + size)
+        else:
+            s.files += 1
+            if s.depth == 0:
+                s.depth = 1
+            ext = extension(c.basename)
+            e = extensions.get(ext)
+            extensions[ext] = (1, c.size) if e is None else (e[0] + 1, e[1] + c.size)
+    return s
+
+
+def _is_columnar(node):
+    # a columnar.ColumnarNode (not imported: columnar imports transaction, which imports this)
+    return getattr(node, 'tree', None) is not None
+
+
+def _columnar_aggregate(tree):
+    """DirStats for the root of a ColumnarTree, from its arrays"""
+    s = DirStats()
+    n = len(tree)
+    is_dir = (tree.kind == KIND_CODES[DIRECTORY]) | (tree.first_child != -1)
+    s.dirs = int(is_dir[1:].sum())
+    # entries are grouped by depth: the deepest level is the last entry's
+    s.depth = bisect.bisect_right(tree.levels, n - 1) - 1
+    names, offsets, size = tree.names, tree.name_offsets, tree.size
+    extensions = s.extensions
+    for i in (~is_dir).nonzero()[0].tolist():
+        ext = extension(os.fsdecode(names[offsets[i]:offsets[i + 1]]))
+        e = extensions.get(ext)
+        extensions[ext] = (1, int(size[i])) if e is None else (e[0] + 1, e[1] + int(size[i]))
+        s.files += 1
+    return s
+
+
+def invalidate_stats(nodes):
+    """drop cached stats, for the ancestors of a node that was edited"""
+    for node in nodes:
+        if isinstance(node, DirectoryNode):
+            node.stats = None
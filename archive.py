@@ -0,0 +1,386 @@
+"""
+saved scans
+
+binary archive layout, version 2 (all integers little-endian):
+- header: magic b'TMARCH\\0\\0', u16 version, u16 compression, u32 metadata
+  length, then the metadata as json (root, host, options, timestamps)
+- body, compressed as a whole with gzip or lzma when the header says so:
+  - node table: one fixed-size record per node, in breadth-first order:
+    u8 kind, u32 name id, i64 size, u32 details id, u32 child count, u32
+    index of the first child. children are contiguous, so a directory's
+    children can be read without reading anything else.
+  - string table: all strings (names, details as json) as one utf-8 blob,
+    then u64 offsets into it, one per string plus the end. each string is
+    stored once, however many nodes use it.
+  - footer: u64 node count, u64 string count, u64 blob length
+  NO_STRING as a details id means no details.
+
+the writer streams the node table one chunk at a time and keeps only the
+strings. uncompressed archives are read in place from an mmap, and
+open_archive materializes directories only when their children are first
+read: opening a huge archive costs about as much as opening a small one,
+and zooming in pages deeper levels in. the least recently used directories
+are dropped again (and re-read on demand) once more than max_nodes are
+loaded. compressed archives are decompressed into memory first.
+
+version 1 archives (a stream of string and node records in preorder) and
+archives written before the binary format (one json document of
+tree_to_dict output) are still loaded, in full.
+"""
+import collections
+import gzip
+import json
+import lzma
+import mmap
+import os
+import struct
+import sys
+import time
+
+from logger import logger
+from scan import DIRECTORY, KIND_CODES, KINDS, DirectoryNode, TreeNode, dict_to_tree, tree_to_dict
+
+
+MAGIC = b'TMARCH\0\0'
+VERSION = 2
+COMPRESSION = {None: 0, 'gzip': 1, 'lzma': 2}
+CHUNK_SIZE = 1 << 20
+NO_STRING = 0xffffffff
+# materialized nodes kept by a lazily opened archive
+DEFAULT_MAX_NODES = 2000000
+
+_header = struct.Struct('<8sHHI')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+_record = struct.Struct('<BIqIII')
+_footer = struct.Struct('<QQQ')
+# version 1
+_node_v1 = struct.Struct('<BIqII')
+_STRING = ord('S')
+_NODE = ord('N')
+
+
+class ArchiveWriter(object):
+    """streams one tree in breadth-first order, see save_archive"""
+    def __init__(self, f, metadata=None, compression=None):
+        meta = json.dumps(metadata or {}).encode()
+        f.write(_header.pack(MAGIC, VERSION, COMPRESSION[compression], len(meta)))
+        f.write(meta)
+        self.f = f
+        if compression == 'gzip':
+            self.out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+        elif compression == 'lzma':
+            self.out = lzma.LZMAFile(f, 'wb')
+        else:
+            self.out = f
+        self.strings = {}
+        self.encoded = []
+        self.buf = bytearray()
+        self.nodes = 0
+
+    def _string(self, s):
+        n = self.strings.get(s)
+        if n is None:
+            n = self.strings[s] = len(self.encoded)
+            self.encoded.append(s.encode('utf-8', 'surrogateescape'))
+        return n
+
+    def add(self, name, size, kind, details, nchildren, first_child):
+        details_id = self._string(json.dumps(details)) if details else NO_STRING
+        self.buf += _record.pack(KIND_CODES[kind], self._string(name), size, details_id,
+                                 nchildren, first_child)
+        self.nodes += 1
+        if len(self.buf) >= CHUNK_SIZE:
+            self.out.write(self.buf)
+            self.buf = bytearray()
+
+    def close(self):
+        self.out.write(self.buf)
+        self.buf = bytearray()
+        offsets = [0]
+        for data in self.encoded:
+            self.out.write(data)
+            offsets.append(offsets[-1] + len(data))
+        self.out.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        self.out.write(_footer.pack(self.nodes, len(self.encoded), offsets[-1]))
+        if self.out is not self.f:
+            # the compressor, leaving the file to the caller
+            self.out.close()
+
+
+def save_archive(path, t, metadata=None, compression=None, fmt='binary'):
+    """write t to path, through a temporary file so a failed save leaves no partial archive"""
+    t0 = time.time()
+    tmp = path + '.tmp'
+    if fmt == 'json':
+        data = dict(metadata or {})
+        data['tree'] = tree_to_dict(t)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+    else:
+        with open(tmp, 'wb') as f:
+            w = ArchiveWriter(f, metadata, compression)
+            queue = collections.deque([t])
+            # index the next child list will start at
+            next_index = 1
+            while queue:
+                node = queue.popleft()
+                name = node.path if node is t else node.basename
+                children = node.children
+                w.add(name, node.size, node.kind, node._details, len(children), next_index)
+                next_index += len(children)
+                queue.extend(children)
+            w.close()
+    os.replace(tmp, path)
+    logger.info('%f sec to save archive %s (%s)' % (time.time() - t0, path, fmt))
+
+
+def load_archive(path):
+    """(tree, metadata) from an archive in any format, fully materialized"""
+    return open_archive(path, lazy=False)
+
+
+def open_archive(path, lazy=True, max_nodes=DEFAULT_MAX_NODES):
+    """
+    (tree, metadata) from an archive in any format. with lazy, version 2
+    archives load directories on demand, see module docstring.
+    """
+    t0 = time.time()
+    with open(path, 'rb') as f:
+        head = f.read(_header.size)
+        if not head.startswith(MAGIC):
+            # json archive
+            f.seek(0)
+            data = json.load(f)
+            t = dict_to_tree(data.pop('tree'))
+            logger.info('%f sec to load json archive %s' % (time.time() - t0, path))
+            return t, data
+
+        _, version, compression, meta_len = _header.unpack(head)
+        if version > VERSION:
+            raise ValueError('%s: archive version %d is newer than this treemonger (%d)' %
+                             (path, version, VERSION))
+        metadata = json.loads(f.read(meta_len))
+        body = _header.size + meta_len
+        if compression == COMPRESSION['gzip']:
+            f.seek(body)
+            buf, body = gzip.GzipFile(fileobj=f, mode='rb').read(), 0
+        elif compression == COMPRESSION['lzma']:
+            f.seek(body)
+            buf, body = lzma.LZMAFile(f, 'rb').read(), 0
+        else:
+            # stays valid after the file is closed
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if version == 1:
+        if isinstance(buf, mmap.mmap):
+            with buf:
+                t = _read_tree_v1(_mapped_chunks(buf, body))
+        else:
+            t = _read_tree_v1(_mapped_chunks(buf, body))
+    elif lazy:
+        t = ArchiveReader(buf, body, max_nodes).root()
+    else:
+        t = ArchiveReader(buf, body).read_all()
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    logger.info('%f sec to %s archive %s' % (time.time() - t0, 'open' if lazy else 'load', path))
+    return t, metadata
+
+
+class ArchiveReader(object):
+    """random access to the node table of a version 2 archive body"""
+    def __init__(self, buf, base, max_nodes=None):
+        self.buf = buf
+        self.base = base
+        self.nodes, nstrings, blob_len = _footer.unpack_from(buf, len(buf) - _footer.size)
+        self.blob = base + self.nodes * _record.size
+        self.offsets = self.blob + blob_len
+        self.strings = {}
+        # lazy mode: loaded directories, least recently used first
+        self.max_nodes = max_nodes
+        self.lru = collections.OrderedDict()
+        self.loaded = 0
+
+    def string(self, n):
+        s = self.strings.get(n)
+        if s is None:
+            start, end = struct.unpack_from('<QQ', self.buf, self.offsets + 8 * n)
+            s = self.buf[self.blob + start:self.blob + end].decode('utf-8', 'surrogateescape')
+            s = self.strings[n] = sys.intern(s)
+        return s
+
+    def node(self, i, parent, lazy):
+        kind, name, size, details, nchildren, first_child = _record.unpack_from(
+            self.buf, self.base + i * _record.size)
+        kind = KINDS[kind]
+        if kind == DIRECTORY and lazy:
+            node = ArchiveDirectoryNode(self.string(name), size, parent)
+            node._reader = self
+            node._first = first_child if nchildren else 0
+            node._count = nchildren
+            if nchildren:
+                # marks the children as not loaded yet
+                TreeNode.children.__set__(node, None)
+        elif kind == DIRECTORY:
+            node = DirectoryNode(self.string(name), size, parent)
+        else:
+            node = TreeNode(self.string(name), size, parent, kind)
+        if details != NO_STRING:
+            node.details = json.loads(self.string(details))
+        return node, nchildren
+
+    def root(self):
+        root, _ = self.node(0, None, True)
+        self.lru[id(root)] = root
+        return root
+
+    def read_all(self):
+        """the whole tree as plain nodes; breadth-first, so each parent's children come in a row"""
+        root, nchildren = self.node(0, None, False)
+        # parents whose children are still to come, and how many
+        parents = collections.deque()
+        if nchildren:
+            root.children = []
+            parents.append([root, nchildren])
+        for i in range(1, self.nodes):
+            entry = parents[0]
+            node, nchildren = self.node(i, entry[0], False)
+            entry[0].children.append(node)
+            entry[1] -= 1
+            if entry[1] == 0:
+                parents.popleft()
+            if nchildren:
+                node.children = []
+                parents.append([node, nchildren])
+        return root
+
+    def load(self, d):
+        """materialize the children of d, evicting others if over max_nodes"""
+        children = [self.node(i, d, True)[0] for i in range(d._first, d._first + d._count)]
+        TreeNode.children.__set__(d, children)
+        self.loaded += len(children)
+        self.lru[id(d)] = d
+        parent = d.parent
+        if isinstance(parent, ArchiveDirectoryNode):
+            parent._loaded += 1
+        if self.max_nodes is not None and self.loaded > self.max_nodes:
+            self._evict(d)
+        return children
+
+    def touch(self, d):
+        if id(d) in self.lru:
+            self.lru.move_to_end(id(d))
+
+    def pin(self, d):
+        """keep d's children (e.g. after an edit) for as long as the tree lives"""
+        self.lru.pop(id(d), None)
+        d._loaded += 1
+
+    def _evict(self, keep):
+        # only directories without loaded subdirectories are dropped, so the
+        # parents of anything loaded (and the root) always stay
+        victims = []
+        for d in self.lru.values():
+            if self.loaded <= self.max_nodes * 3 // 4:
+                break
+            if d._loaded or d is keep or d.parent is None:
+                continue
+            victims.append(d)
+            self.loaded -= d._count
+        for d in victims:
+            del self.lru[id(d)]
+            TreeNode.children.__set__(d, None)
+            if isinstance(d.parent, ArchiveDirectoryNode):
+                d.parent._loaded -= 1
+        if victims:
+            logger.debug('archive: dropped %d directories, %d nodes loaded' % (len(victims), self.loaded))
+
+
+class ArchiveDirectoryNode(DirectoryNode):
+    """a DirectoryNode whose children are read from an open archive on first access"""
+    __slots__ = ('_reader', '_first', '_count', '_loaded')
+
+    def __init__(self, path, size=0, parent=None):
+        self._loaded = 0
+        DirectoryNode.__init__(self, path, size, parent)
+
+    @property
+    def children(self):
+        children = TreeNode.children.__get__(self)
+        if children is None:
+            return self._reader.load(self)
+        if children:
+            self._reader.touch(self)
+        return children
+
+    @children.setter
+    def children(self, children):
+        TreeNode.children.__set__(self, children)
+
+    def add_child(self, node):
+        self._reader.pin(self)
+        DirectoryNode.add_child(self, node)
+
+    def remove_child(self, node):
+        self._reader.pin(self)
+        DirectoryNode.remove_child(self, node)
+
+    def replace_child(self, old, new):
+        self._reader.pin(self)
+        DirectoryNode.replace_child(self, old, new)
+
+
+def _mapped_chunks(buf, pos):
+    """version 1: (buffer, start, end) for each chunk, read in place"""
+    while True:
+        (n,) = _u32.unpack_from(buf, pos)
+        if n == 0:
+            return
+        yield buf, pos + 4, pos + 4 + n
+        pos += 4 + n
+
+
+def _read_tree_v1(chunks):
+    strings = []
+    root = None
+    # [node, children still to read]
+    stack = []
+    unpack_node = _node_v1.unpack_from
+    node_size = _node_v1.size
+    for buf, pos, end in chunks:
+        while pos < end:
+            tag = buf[pos]
+            if tag == _STRING:
+                (n,) = _u32.unpack_from(buf, pos + 1)
+                pos += 5
+                strings.append(sys.intern(buf[pos:pos + n].decode('utf-8', 'surrogateescape')))
+                pos += n
+                continue
+            if tag != _NODE:
+                raise ValueError('corrupt archive: unknown record %r' % tag)
+            kind, name, size, details, nchildren = unpack_node(buf, pos + 1)
+            pos += 1 + node_size
+
+            parent = stack[-1][0] if stack else None
+            kind = KINDS[kind]
+            if kind == DIRECTORY:
+                node = DirectoryNode(strings[name], size, parent)
+            else:
+                node = TreeNode(strings[name], size, parent, kind)
+            if details != NO_STRING:
+                node.details = json.loads(strings[details])
+            if parent is None:
+                root = node
+            else:
+                parent.children.append(node)
+                stack[-1][1] -= 1
+            if nchildren:
+                node.children = []
+                stack.append([node, nchildren])
+            else:
+                while stack and stack[-1][1] == 0:
+                    stack.pop()
+    if root is None:
+        raise ValueError('corrupt archive: no nodes')
+    return root
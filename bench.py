@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""
+performance comparisons for treemonger internals
+
+./bench.py scan [path]                  # legacy walker vs scandir engine: syscalls and files/sec
+./bench.py scan --threads=1,4,16 [path]  # also run the parallel walker at these thread counts
+./bench.py scan --latency-ms=0.2 ...     # add simulated per-syscall latency (network volume)
+./bench.py deep --depth=12000           # build a directory chain that deep and scan it with each engine
+./bench.py memory --nodes=1000000       # bytes per TreeNode, compared to the previous layout, on a synthetic
+                                        # tree and a real one (the python standard library)
+./bench.py memory --path=/usr           # ... with a scan of that directory as the real tree
+./bench.py archive --nodes=1000000      # save/load time and size: json vs binary archives
+./bench.py archive --path=/usr          # ... for a scan of a real tree
+./bench.py layout --resizes=1000        # time and memory over consecutive layouts at changing window sizes
+./bench.py wide --children=500000       # layout of one wide directory: python splits vs numpy kernel
+./bench.py diff --nodes=1000000         # diff two synthetic scans that differ in every directory
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import functools
+
+from archive import load_archive, open_archive, save_archive
+from columnar import numpy_present, scan_columnar
+from diff import diff_trees
+import subdivide
+from subdivide import LayoutEngine
+from scan import FILE, DirectoryNode, TreeNode, get_directory_tree, scan_directory_tree, scan_directory_tree_parallel, tree_to_dict
+
+
+class SyscallCounter(object):
+    """
+    count filesystem calls made through the os module while active
+
+    os.path.* helpers all bottom out in os.stat/os.lstat, so patching those
+    (plus listdir/scandir, and DirEntry.stat on first use) counts real syscalls
+    made from python, including the ones hidden inside realpath and ismount.
+    """
+    names = ['stat', 'lstat', 'listdir', 'scandir']
+
+    def __init__(self, latency=0):
+        # optional per-call sleep, to imitate a network filesystem
+        self.latency = latency
+        self.counts = {}
+        self._orig = {}
+
+    def __enter__(self):
+        self.counts = {n: 0 for n in self.names + ['DirEntry.stat']}
+        for n in self.names:
+            self._orig[n] = getattr(os, n)
+            setattr(os, n, self._wrap(n, self._orig[n]))
+        return self
+
+    def __exit__(self, *exc):
+        for n in self.names:
+            setattr(os, n, self._orig[n])
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def _wrap(self, name, func):
+        counter = self
+
+        def wrapped(*args, **kwargs):
+            counter.counts[name] += 1
+            if counter.latency:
+                time.sleep(counter.latency)
+            res = func(*args, **kwargs)
+            if name == 'scandir':
+                return _CountingScandir(res, counter)
+            return res
+        return wrapped
+
+
+class _CountingScandir(object):
+    def __init__(self, it, counter):
+        self.it = it
+        self.counter = counter
+
+    def __iter__(self):
+        for entry in self.it:
+            yield _CountingEntry(entry, self.counter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.it.close()
+
+
+class _CountingEntry(object):
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+        self._stat = None
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._counter.counts['DirEntry.stat'] += 1
+            if self._counter.latency:
+                time.sleep(self._counter.latency)
+            self._stat = self._entry.stat(follow_symlinks=follow_symlinks)
+        return self._stat
+
+
+def count_leaves(t):
+    # entries without children, for the files/sec figures
+    stack = [t]
+    n = 0
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(node.children)
+        else:
+            n += 1
+    return n
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+def bench_scan(path, threads=[], latency=0):
+    engines = [
+        ('get_directory_tree', get_directory_tree),
+        ('scan_directory_tree', scan_directory_tree),
+    ]
+    for n in threads:
+        engines.append(('parallel, %d threads' % n,
+                        functools.partial(scan_directory_tree_parallel, threads=n)))
+    trees = []
+    print('scanning %s' % os.path.realpath(path))
+    for label, func in engines:
+        # warm the dentry/inode cache so both engines see the same conditions
+        func(path)
+        with SyscallCounter() as sc:
+            func(path)
+        if latency:
+            with SyscallCounter(latency):
+                t, dt = timed(func, path)
+        else:
+            t, dt = timed(func, path)
+        trees.append(t)
+        nfiles = count_leaves(t)
+        calls = ', '.join('%s=%d' % kv for kv in sorted(sc.counts.items()) if kv[1])
+        print('  %-22s %8d files  %7.3fs  %10.0f files/sec  %5.2f calls/file  (%s)' %
+              (label, nfiles, dt, nfiles / dt, sc.total / nfiles, calls))
+    reference = tree_to_dict(trees[0])
+    same = all(tree_to_dict(t) == reference for t in trees[1:])
+    print('  identical trees: %s' % same)
+
+
+def make_deep_tree(root, depth):
+    """
+    root/d/d/d/... with one small file per level. paths soon exceed PATH_MAX,
+    so each level is created relative to a descriptor for the one above.
+    """
+    fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+    for n in range(depth):
+        with open('f', 'w', opener=lambda name, flags: os.open(name, flags, dir_fd=fd)) as f:
+            f.write('x' * (n % 100))
+        os.mkdir('d', dir_fd=fd)
+        next_fd = os.open('d', os.O_RDONLY | os.O_DIRECTORY, dir_fd=fd)
+        os.close(fd)
+        fd = next_fd
+    os.close(fd)
+
+
+def remove_deep_tree(root):
+    # shutil.rmtree recurses per level, so peel the chain from the top instead:
+    # move root/d/d up to root/_, drop root/d, and rename root/_ back to root/d
+    top = os.path.join(root, 'd')
+    tmp = os.path.join(root, '_')
+    while os.path.isdir(top):
+        if os.path.exists(os.path.join(top, 'f')):
+            os.unlink(os.path.join(top, 'f'))
+        if os.path.isdir(os.path.join(top, 'd')):
+            os.rename(os.path.join(top, 'd'), tmp)
+            os.rmdir(top)
+            os.rename(tmp, top)
+        else:
+            os.rmdir(top)
+    os.unlink(os.path.join(root, 'f'))
+    os.rmdir(root)
+
+
+def same_tree(a, b):
+    """iterative equivalent of tree_to_dict(a) == tree_to_dict(b)"""
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if (a.path, a.size, a.details, len(a.children)) != (b.path, b.size, b.details, len(b.children)):
+            return False
+        stack.extend(zip(a.children, b.children))
+    return True
+
+
+def max_depth(t):
+    stack = [(t, 0)]
+    deepest = 0
+    while stack:
+        node, depth = stack.pop()
+        deepest = max(deepest, depth)
+        stack.extend((c, depth + 1) for c in node.children)
+    return deepest
+
+
+def bench_deep(depth, threads=[]):
+    engines = [
+        ('get_directory_tree', get_directory_tree),
+        ('scan_directory_tree', scan_directory_tree),
+    ]
+    for n in threads:
+        engines.append(('parallel, %d threads' % n,
+                        functools.partial(scan_directory_tree_parallel, threads=n)))
+    root = tempfile.mkdtemp(prefix='treemonger-deep-')
+    try:
+        t, dt = timed(make_deep_tree, root, depth)
+        print('built %d levels under %s (%.3fs)' % (depth, root, dt))
+        trees = []
+        for label, func in engines:
+            try:
+                t, dt = timed(func, root)
+            except RecursionError:
+                print('  %-22s RecursionError' % label)
+                continue
+            trees.append(t)
+            print('  %-22s depth %6d  %8d files  %7.3fs' % (label, max_depth(t), count_leaves(t), dt))
+        print('  identical trees: %s' % all(same_tree(trees[0], t) for t in trees[1:]))
+    finally:
+        remove_deep_tree(root)
+
+
+class PathTreeNode(object):
+    """TreeNode as it was before __slots__: full path string, children list and details dict per node"""
+    def __init__(self, path, size=0):
+        self.path = path
+        self.size = size
+        self.children = []
+        self.details = {}
+        self.mtime = None
+        self.inode = None
+
+
+def build_path_tree(root, fanout, nfiles):
+    t = PathTreeNode(root)
+    for a in range(fanout):
+        da = PathTreeNode('%s/module_%03d' % (root, a))
+        t.children.append(da)
+        for b in range(fanout):
+            db = PathTreeNode('%s/package_%03d' % (da.path, b))
+            da.children.append(db)
+            for c in range(nfiles):
+                db.children.append(PathTreeNode('%s/source_file_%03d.py' % (db.path, c), 1000 + c))
+    return t
+
+
+def build_slot_tree(root, fanout, nfiles):
+    # names are interned, as the scanner does
+    t = DirectoryNode(root)
+    t.children = []
+    for a in range(fanout):
+        da = DirectoryNode(sys.intern('module_%03d' % a), 0, t)
+        da.children = []
+        t.children.append(da)
+        for b in range(fanout):
+            db = DirectoryNode(sys.intern('package_%03d' % b), 0, da)
+            db.children = []
+            da.children.append(db)
+            for c in range(nfiles):
+                db.children.append(TreeNode(sys.intern('source_file_%03d.py' % c), 1000 + c, db, FILE))
+    return t
+
+
+def path_tree_from(t):
+    """copy of a scanned tree in the PathTreeNode layout"""
+    copy = PathTreeNode(t.path, t.size)
+    stack = [(t, copy)]
+    while stack:
+        node, node_copy = stack.pop()
+        for c in node.children:
+            child_copy = PathTreeNode(node_copy.path + os.sep + c.basename, c.size)
+            child_copy.mtime = c.mtime
+            child_copy.inode = c.inode
+            if c._details:
+                child_copy.details = dict(c._details)
+            node_copy.children.append(child_copy)
+            stack.append((c, child_copy))
+    return copy
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    res = func(*args)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return res, used
+
+
+def bench_memory(nodes, root='/home/user/src/project'):
+    # two directory levels of `fanout` each, files below: about `nodes` in total
+    fanout = 100
+    nfiles = max(1, nodes // (fanout * fanout) - 1)
+    total = 1 + fanout + fanout * fanout * (1 + nfiles)
+    print('%d nodes, %d files per directory, paths like %s/module_000/package_000/source_file_000.py' %
+          (total, nfiles, root))
+    results = []
+    for label, build in [('path per node', build_path_tree), ('__slots__ + parent', build_slot_tree)]:
+        t, used = measure(build, root, fanout, nfiles)
+        results.append(used)
+        print('  %-20s %8.1f MB  %6.1f bytes/node' % (label, used / 1e6, used / total))
+        del t
+    # long, repetitive paths favor the new layout: see bench_memory_scan for a real tree
+    print('  reduction: %.2fx (synthetic)' % (results[0] / results[1]))
+
+
+def bench_memory_scan(path):
+    # same comparison for a real tree; nodes are counted from the scan
+    t, used = measure(scan_directory_tree, path)
+    total = 0
+    stack = [t]
+    while stack:
+        node = stack.pop()
+        total += 1
+        stack.extend(node.children)
+    copy, copy_used = measure(path_tree_from, t)
+    print('%s: %d nodes' % (os.path.realpath(path), total))
+    print('  %-20s %8.1f MB  %6.1f bytes/node' % ('path per node', copy_used / 1e6, copy_used / total))
+    print('  %-20s %8.1f MB  %6.1f bytes/node' % ('__slots__ + parent', used / 1e6, used / total))
+    print('  reduction: %.2fx' % (copy_used / used))
+    if numpy_present:
+        ct, col_used = measure(scan_columnar, path)
+        print('  %-20s %8.1f MB  %6.1f bytes/node' % ('columnar', col_used / 1e6, col_used / len(ct)))
+        print('  reduction: %.2fx' % (copy_used / col_used))
+
+
+def bench_archive(nodes, path=None):
+    if path:
+        t = scan_directory_tree(path)
+        print('archives of %s' % os.path.realpath(path))
+    else:
+        fanout = 100
+        t = build_slot_tree('/home/user/src/project', fanout, max(1, nodes // (fanout * fanout) - 1))
+        print('archives of a synthetic tree')
+    total = 0
+    stack = [t]
+    while stack:
+        node = stack.pop()
+        total += 1
+        stack.extend(node.children)
+    print('  %d nodes' % total)
+    reference = tree_to_dict(t)
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, fmt, compression in [('json', 'json', None),
+                                        ('binary', 'binary', None),
+                                        ('binary + gzip', 'binary', 'gzip'),
+                                        ('binary + lzma', 'binary', 'lzma')]:
+            fname = os.path.join(tmp, label.replace(' ', ''))
+            _, save_dt = timed(save_archive, fname, t, {}, compression, fmt)
+            (loaded, _), load_dt = timed(load_archive, fname)
+            same = tree_to_dict(loaded) == reference
+            del loaded
+            # lazy: only the root until children are read
+            _, open_dt = timed(open_archive, fname)
+            print('  %-14s %8.1f MB  save %6.2fs (%9.0f nodes/sec)  load %6.2fs (%9.0f nodes/sec)  open %7.4fs  identical: %s' %
+                  (label, os.path.getsize(fname) / 1e6, save_dt, total / save_dt, load_dt, total / load_dt, open_dt, same))
+
+
+def bench_diff(nodes):
+    fanout = 100
+    nfiles = max(1, nodes // (fanout * fanout) - 1)
+    old = build_slot_tree('/home/user/src/project', fanout, nfiles)
+    new = build_slot_tree('/home/user/src/project', fanout, nfiles)
+    # in every directory: one file grown, one removed, one added, and the listing reordered
+    for da in new.children:
+        for db in da.children:
+            files = db.children
+            files[0].size += 4096
+            del files[-1]
+            files.append(TreeNode('new_file.py', 100, db, FILE))
+            files.reverse()
+    total = 1 + fanout + fanout * fanout * (1 + nfiles)
+    print('diff of two synthetic trees, %d nodes each' % total)
+    d, dt = timed(diff_trees, old, new)
+    print('  %6.2fs  %9.0f nodes/sec  growth %d bytes' % (dt, total / dt, d.details.get('growth', 0)))
+
+
+LAYOUT_PARAMS = {
+    'max_filesystem_depth': 16,
+    'min_box_size': 10,
+    'size_mode': 'bytes',
+    'text_size': 8,
+    'dir_text_offset': 6,
+    'xpad': 0,
+    'ypad': 0,
+}
+
+
+def bench_layout(resizes, path=None):
+    if path:
+        t = scan_directory_tree(path)
+        print('layouts of %s' % os.path.realpath(path))
+    else:
+        t = build_slot_tree('/home/user/src/project', 30, 30)
+        stack = [t]
+        order = []
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node.children)
+        for node in reversed(order):
+            if node.children:
+                node.size = sum(c.size for c in node.children)
+        print('layouts of a synthetic tree')
+    block = max(1, resizes // 10)
+    # without the layout cache first, so the memory of the layouts themselves shows on its own
+    for label, engine in [('no layout cache', LayoutEngine(0)), ('layout cache', LayoutEngine())]:
+        print('%s:' % label)
+        gc.collect()
+        tracemalloc.start()
+        t0 = time.time()
+        for n in range(resizes):
+            # a window being dragged between two sizes
+            width = 800 + (n * 7) % 400
+            height = 600 + (n * 5) % 300
+            rects = engine.layout(t, [0, width], [0, height], LAYOUT_PARAMS)
+            if (n + 1) % block == 0:
+                used = tracemalloc.get_traced_memory()[0]
+                print('  layouts %5d-%5d  %7.2f ms/layout  %6d rects  %8.1f kB traced' %
+                      (n + 2 - block, n + 1, (time.time() - t0) / block * 1000, len(rects), used / 1e3))
+                t0 = time.time()
+        if engine.max_cached_rects:
+            print('  cache: %d hits, %d scaled, %d misses, %d rects cached (max %d)' %
+                  (engine.hits, engine.scaled, engine.misses, engine._cached_rects, engine.max_cached_rects))
+        del rects
+        tracemalloc.stop()
+
+
+def bench_wide(children):
+    random.seed(0)
+    t = DirectoryNode('/var/spool/mail')
+    # mostly small files, a few large ones
+    t.children = [TreeNode('msg_%07d' % n, int(random.paretovariate(1.2) * 2000), t, FILE)
+                  for n in range(children)]
+    t.size = sum(c.size for c in t.children)
+    print('layout of one directory with %d files' % children)
+    kernel_min = subdivide.KERNEL_MIN_CHILDREN
+    results = []
+    for label, enabled in [('python', False), ('numpy', True)]:
+        if enabled and not numpy_present:
+            print('  numpy not available')
+            continue
+        subdivide.KERNEL_MIN_CHILDREN = kernel_min if enabled else sys.maxsize
+        try:
+            rects, dt = timed(subdivide.compute_rectangles, t, [0, 1600], [0, 1000], LAYOUT_PARAMS)
+        finally:
+            subdivide.KERNEL_MIN_CHILDREN = kernel_min
+        results.append(rects)
+        print('  %-8s %7.3fs  %6d rects' % (label, dt, len(rects)))
+    if len(results) == 2:
+        same = all(a['path'] == b['path'] and abs(a['x'] - b['x']) < 1e-6 and abs(a['y'] - b['y']) < 1e-6 and
+                   abs(a['dx'] - b['dx']) < 1e-6 and abs(a['dy'] - b['dy']) < 1e-6
+                   for a, b in zip(*results)) and len(results[0]) == len(results[1])
+        print('  same rects: %s' % same)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('scan')
+    p.add_argument('path', nargs='?', default='.')
+    p.add_argument('--threads', default='', help='comma-separated thread counts')
+    p.add_argument('--latency-ms', type=float, default=0, help='simulated latency per fs call')
+    p = sub.add_parser('deep')
+    p.add_argument('--depth', type=int, default=12000)
+    p.add_argument('--threads', default='', help='comma-separated thread counts')
+    p = sub.add_parser('memory')
+    p.add_argument('--nodes', type=int, default=1000000)
+    p.add_argument('--path', default=os.path.dirname(os.__file__),
+                   help='also compare on a scan of this directory (default: the standard library)')
+    p = sub.add_parser('archive')
+    p.add_argument('--nodes', type=int, default=1000000)
+    p.add_argument('--path', help='archive a scan of this directory instead of a synthetic tree')
+    p = sub.add_parser('layout')
+    p.add_argument('--resizes', type=int, default=1000)
+    p.add_argument('--path', help='lay out a scan of this directory instead of a synthetic tree')
+    p = sub.add_parser('wide')
+    p.add_argument('--children', type=int, default=500000)
+    p = sub.add_parser('diff')
+    p.add_argument('--nodes', type=int, default=1000000)
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        threads = [int(n) for n in args.threads.split(',') if n]
+        bench_scan(args.path, threads, args.latency_ms / 1000)
+    elif args.command == 'deep':
+        threads = [int(n) for n in args.threads.split(',') if n]
+        bench_deep(args.depth, threads)
+    elif args.command == 'memory':
+        bench_memory(args.nodes)
+        bench_memory_scan(args.path)
+    elif args.command == 'archive':
+        bench_archive(args.nodes, args.path)
+    elif args.command == 'layout':
+        bench_layout(args.resizes, args.path)
+    elif args.command == 'wide':
+        bench_wide(args.children)
+    elif args.command == 'diff':
+        bench_diff(args.nodes)
+
+
+if __name__ == '__main__':
+    main()
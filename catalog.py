@@ -0,0 +1,83 @@
+"""
+index of saved archives, in a sqlite database next to them
+
+one row per archive file: host, scanned root, scan timestamp (the NOW string,
+which sorts by time), scan duration, total size and file count. save_scan
+adds a row for every archive it writes, so finding the latest scan of a root
+is one indexed lookup instead of a glob and a stat per archive file.
+"""
+import os
+import sqlite3
+
+from logger import logger
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    root TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    duration REAL,
+    size INTEGER,
+    files INTEGER
+);
+CREATE INDEX IF NOT EXISTS archives_host_root_timestamp ON archives (host, root, timestamp);
+CREATE INDEX IF NOT EXISTS archives_timestamp ON archives (timestamp);
+"""
+COLUMNS = ('path', 'host', 'root', 'timestamp', 'duration', 'size', 'files')
+
+
+class Catalog(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add(self, path, host, root, timestamp, duration=None, size=None, files=None):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (os.path.abspath(path), host, root, timestamp, duration, size, files))
+
+    def remove(self, path):
+        with self.db:
+            self.db.execute('DELETE FROM archives WHERE path = ?', (os.path.abspath(path),))
+
+    def latest(self, host, root):
+        """path of the newest archive of root scanned on host that still exists, or ''"""
+        while True:
+            row = self.db.execute('SELECT path FROM archives WHERE host = ? AND root = ? '
+                                  'ORDER BY timestamp DESC LIMIT 1', (host, root)).fetchone()
+            if row is None:
+                return ''
+            if os.path.exists(row[0]):
+                return row[0]
+            logger.info('archive %s is gone, dropping it from the catalog' % row[0])
+            self.remove(row[0])
+
+    def archives(self, host=None, root=None):
+        """rows as dicts (see COLUMNS), newest first, optionally for one host and/or root"""
+        where = []
+        args = []
+        if host is not None:
+            where.append('host = ?')
+            args.append(host)
+        if root is not None:
+            where.append('root = ?')
+            args.append(root)
+        query = 'SELECT %s FROM archives' % ', '.join(COLUMNS)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY timestamp DESC'
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(query, args)]
@@ -0,0 +1,321 @@
+"""
+columnar tree store, for scans too big for one python object per entry
+
+entries live in parallel numpy arrays indexed by entry number:
+- parent, first_child, next_sibling: int32 links, -1 for none
+- size: int64 bytes; after the scan, directories hold their subtree totals
+- kind: uint8, index into KINDS
+names are utf-8/surrogateescape bytes in one contiguous blob, entry i's name
+being names[name_offsets[i]:name_offsets[i + 1]]. the root's name is the
+path it was scanned with. details (skip reasons) are kept in a dict for the
+few entries that have any.
+
+directories are listed breadth-first and each directory's entries are
+appended together, so a parent always comes before its children, siblings
+are contiguous, and entries are grouped by depth. subtree sizes are then
+summed level by level from the deepest, one vectorized np.add.at per level.
+
+ColumnarNode is a thin facade over one entry, with the TreeNode attributes
+that compute_rectangles, tree_to_dict and the renderers read (path, size,
+children, details, name...). it is created on access and holds no data.
+"""
+import array
+import collections
+import os
+import time
+
+try:
+    import numpy as np
+    numpy_present = True
+except ImportError:
+    numpy_present = False
+
+from logger import logger
+from scan import DIRECTORY, KIND_CODES, KINDS, ScanOptions, _NewDetails, _classify, _read_dir, _scan_root
+from transaction import TreeMismatch
+
+
+class ColumnarTree(object):
+    def __init__(self, parent, first_child, next_sibling, size, kind, names, name_offsets,
+                 details=None, levels=None):
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.size = size
+        self.kind = kind
+        self.names = names
+        self.name_offsets = name_offsets
+        # entry index -> details dict, only for entries that have details
+        self.details = details if details is not None else {}
+        # start index of each depth, see module docstring
+        self.levels = levels if levels is not None else [0]
+        # entry index -> {name: child index}, for directories that were looked into
+        self._child_names = {}
+        # entry index -> aggregates.DirStats, for directories that were aggregated
+        self.stats = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def nbytes(self):
+        arrays = [self.parent, self.first_child, self.next_sibling, self.size, self.kind, self.name_offsets]
+        return sum(a.nbytes for a in arrays) + len(self.names)
+
+    def root(self):
+        return ColumnarNode(self, 0)
+
+    def name(self, i):
+        return os.fsdecode(self.names[self.name_offsets[i]:self.name_offsets[i + 1]])
+
+    def children(self, i):
+        out = []
+        c = int(self.first_child[i])
+        while c != -1:
+            out.append(c)
+            c = int(self.next_sibling[c])
+        return out
+
+    def child(self, i, name):
+        """index of the child of entry i called name, or None"""
+        names = self._child_names.get(i)
+        if names is None:
+            names = self._child_names[i] = {self.name(c): c for c in self.children(i)}
+        return names.get(name)
+
+    def path(self, i):
+        parts = []
+        while i > 0:
+            parts.append(self.name(i))
+            i = int(self.parent[i])
+        parts.append(self.name(0))
+        return os.sep.join(reversed(parts))
+
+    def accumulate_sizes(self):
+        """
+        fill in directory sizes as the sum of their subtrees. levels are
+        processed deepest first, so each level's totals are final before
+        they are added to the level above.
+        """
+        bounds = list(self.levels) + [len(self)]
+        for lo, hi in reversed(list(zip(bounds[:-1], bounds[1:]))):
+            if lo == 0:
+                break
+            np.add.at(self.size, self.parent[lo:hi], self.size[lo:hi])
+
+
+class ColumnarNode(object):
+    """TreeNode-like view of one entry of a ColumnarTree"""
+    __slots__ = ('tree', 'index')
+
+    mtime = None
+    inode = None
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def path(self):
+        return self.tree.path(self.index)
+
+    @property
+    def basename(self):
+        if self.index == 0:
+            return os.path.basename(self.tree.name(0))
+        return self.tree.name(self.index)
+
+    @property
+    def name(self):
+        if self.kind == DIRECTORY:
+            return self.basename + os.sep
+        return self.basename
+
+    @property
+    def kind(self):
+        return KINDS[self.tree.kind[self.index]]
+
+    @property
+    def size(self):
+        return int(self.tree.size[self.index])
+
+    @size.setter
+    def size(self, size):
+        self.tree.size[self.index] = size
+
+    @property
+    def parent(self):
+        if self.index == 0:
+            return None
+        return ColumnarNode(self.tree, int(self.tree.parent[self.index]))
+
+    @property
+    def children(self):
+        # a new list on each access: callers may sort it in place
+        return [ColumnarNode(self.tree, c) for c in self.tree.children(self.index)]
+
+    @property
+    def details(self):
+        # reads must not add an entry to tree.details, see scan._NewDetails
+        details = self.tree.details.get(self.index)
+        if details is None:
+            return _NewDetails(self)
+        return details
+
+    def _attach_details(self):
+        return self.tree.details.setdefault(self.index, {})
+
+    @property
+    def stats(self):
+        # kept on the tree: facades are created on access
+        return self.tree.stats.get(self.index)
+
+    @stats.setter
+    def stats(self, stats):
+        if stats is None:
+            self.tree.stats.pop(self.index, None)
+        else:
+            self.tree.stats[self.index] = stats
+
+    @property
+    def _details(self):
+        # as on TreeNode: None rather than an empty dict when there are none
+        return self.tree.details.get(self.index)
+
+    def child(self, name):
+        c = self.tree.child(self.index, name)
+        if c is None:
+            return None
+        return ColumnarNode(self.tree, c)
+
+    def __getitem__(self, key):
+        c = self.child(key.rstrip(os.sep))
+        if c is None:
+            logger.error('failed to getitem: %s (%s)' % (key, self))
+        return c
+
+    # the arrays are not edited in place; callers rescan instead
+    def add_child(self, node):
+        raise TreeMismatch('the columnar store is read-only')
+
+    def remove_child(self, node):
+        raise TreeMismatch('the columnar store is read-only')
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnarNode) and other.tree is self.tree and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return '<ColumnarNode %s: %d>' % (self.name, self.size)
+
+
+class _Builder(object):
+    """growable typed arrays; converted to numpy without copying python ints"""
+    def __init__(self):
+        self.parent = array.array('i')
+        self.first_child = array.array('i')
+        self.next_sibling = array.array('i')
+        self.size = array.array('q')
+        self.kind = array.array('B')
+        self.names = bytearray()
+        self.name_offsets = array.array('q', [0])
+        self.details = {}
+
+    def add(self, parent, name, size, kind):
+        n = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.size.append(size)
+        self.kind.append(KIND_CODES[kind])
+        self.names += os.fsencode(name)
+        self.name_offsets.append(len(self.names))
+        return n
+
+    def finish(self, levels):
+        return ColumnarTree(
+            np.frombuffer(self.parent, dtype=np.int32).copy(),
+            np.frombuffer(self.first_child, dtype=np.int32).copy(),
+            np.frombuffer(self.next_sibling, dtype=np.int32).copy(),
+            np.frombuffer(self.size, dtype=np.int64).copy(),
+            np.frombuffer(self.kind, dtype=np.uint8).copy(),
+            bytes(self.names),
+            np.frombuffer(self.name_offsets, dtype=np.int64).copy(),
+            self.details,
+            levels,
+        )
+
+
+def scan_columnar(path,
+                  exclude_dirs=[],
+                  exclude_files=[],
+                  exclude_filters=[],
+                  skip_mount=False,
+                  slow_details=False,
+                  exclude_patterns=[],
+                  exclude_root=None,
+                  file_keys=False):
+    """
+    scan path into a ColumnarTree, with the same entries, sizes and skip
+    details as scan_directory_tree. returns the tree; use .root() for a
+    TreeNode-like view. slow_details and file_keys are not supported here.
+    """
+    if not numpy_present:
+        raise ImportError('the columnar tree store needs numpy: pip install numpy')
+    t0 = time.time()
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, False,
+                       exclude_patterns, exclude_root or path)
+    root, realpath, dev = _scan_root(path, opts)
+    b = _Builder()
+    b.add(-1, path, root.size, root.kind)
+    if root._details:
+        b.details[0] = root._details
+    levels = [0]
+
+    # (index, path, realpath, st_dev, depth)
+    queue = collections.deque()
+    if dev is not None:
+        queue.append((0, path, realpath, dev, 0))
+    try:
+        while queue:
+            index, dir_path, dir_realpath, dir_dev, depth = queue.popleft()
+            first = len(b.parent)
+            subdirs = _list_dir_columnar(b, index, dir_path, dir_realpath, dir_dev, opts)
+            end = len(b.parent)
+            if end > first:
+                if len(levels) == depth + 1:
+                    levels.append(first)
+                b.first_child[index] = first
+                for i in range(first, end - 1):
+                    b.next_sibling[i] = i + 1
+            for child, child_path, child_realpath, child_dev in subdirs:
+                queue.append((child, child_path, child_realpath, child_dev, depth + 1))
+    finally:
+        opts.long_dirs.close()
+
+    tree = b.finish(levels)
+    tree.accumulate_sizes()
+    logger.info('%f sec to scan %d entries into columnar store (%.1f MB)' %
+                (time.time() - t0, len(tree), tree.nbytes / 1e6))
+    return tree
+
+
+def _list_dir_columnar(b, index, path, realpath, dev, opts):
+    """scan._list_dir, appending entries to the builder instead of creating TreeNodes"""
+    entries, skip = _read_dir(path, realpath, opts)
+    if entries is None:
+        b.details[index] = {'skip': skip}
+        return []
+
+    subdirs = []
+    prefix = path + os.sep
+    real_prefix = realpath.rstrip(os.sep) + os.sep
+    for name, kind, size, st, details in _classify(entries, path, realpath, dev, opts):
+        child = b.add(index, name, size, kind)
+        if details is not None:
+            b.details[child] = details
+        elif kind == DIRECTORY:
+            subdirs.append((child, prefix + name, real_prefix + name, st.st_dev))
+    return subdirs
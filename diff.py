@@ -0,0 +1,121 @@
+"""
+what changed between two scans of the same root
+
+diff_trees(old, new) returns a new tree holding every path of either scan,
+built in one pass over both: each directory's children are sorted by name
+on both sides and merge-joined, so matching costs O(n log n) in the size of
+each directory (the sort) and nothing across directories. directories listed
+in the same order on both sides, as unchanged ones usually are, skip the sort.
+
+each node of the result has the size from the new scan (0 if removed) and
+these details, when they apply:
+- delta: new size - old size, in bytes (absent when 0)
+- added / removed: True for paths only in the new / old scan. everything
+  below an added or removed directory is marked too.
+- growth: bytes changed below the node, counting growth and shrinkage alike
+  (the sum of abs(delta) over the changed files). the 'growth' size mode of
+  compute_rectangles sizes rects by this, so a directory where a lot changed
+  is big even when its net delta is small.
+"""
+import time
+
+from logger import logger
+from scan import DIRECTORY, DirectoryNode, TreeNode
+from utils import format_bytes
+
+
+def diff_trees(old, new):
+    """tree of the differences from old to new, see module docstring"""
+    t0 = time.time()
+    root = DirectoryNode(new.path, new.size)
+    # (old dir, new dir, output dir), either side None below an added/removed directory
+    stack = [(old, new, root)]
+    # output directories, parents first, to sum growth bottom-up
+    order = []
+    while stack:
+        a, b, out = stack.pop()
+        order.append(out)
+        children = []
+        for name, ca, cb in _merge(a, b):
+            node = cb if cb is not None else ca
+            is_dir = node.kind == DIRECTORY or bool(node.children)
+            if is_dir:
+                child = DirectoryNode(name, 0, out)
+            else:
+                child = TreeNode(name, 0, out, node.kind)
+            size_a = ca.size if ca is not None else 0
+            size_b = cb.size if cb is not None else 0
+            child.size = size_b
+            delta = size_b - size_a
+            if delta or ca is None or cb is None:
+                details = child._details = {}
+                if delta:
+                    details['delta'] = delta
+                    if not is_dir:
+                        details['growth'] = abs(delta)
+                if ca is None:
+                    details['added'] = True
+                elif cb is None:
+                    details['removed'] = True
+            if is_dir:
+                stack.append((ca if _is_dir(ca) else None, cb if _is_dir(cb) else None, child))
+            children.append(child)
+        out.children = children
+
+    if new.size != old.size:
+        root.details['delta'] = new.size - old.size
+    for out in reversed(order):
+        growth = 0
+        for c in out.children:
+            if c._details:
+                growth += c._details.get('growth', 0)
+        if growth:
+            out.details['growth'] = growth
+    logger.info('%f sec to diff %s: %d directories' % (time.time() - t0, new.path, len(order)))
+    return root
+
+
+def _is_dir(node):
+    return node is not None and (node.kind == DIRECTORY or bool(node.children))
+
+
+def _merge(a, b):
+    """[(name, old child or None, new child or None)] for the union of two directories' children"""
+    ca = [(c.basename, c) for c in a.children] if a is not None else []
+    cb = [(c.basename, c) for c in b.children] if b is not None else []
+    if not ca:
+        return [(name, None, c) for name, c in cb]
+    if not cb:
+        return [(name, c, None) for name, c in ca]
+    if len(ca) == len(cb) and all(x[0] == y[0] for x, y in zip(ca, cb)):
+        # same listing order on both sides, the usual case for an unchanged directory
+        return [(x[0], x[1], y[1]) for x, y in zip(ca, cb)]
+
+    ca.sort(key=_first)
+    cb.sort(key=_first)
+    out = []
+    i = j = 0
+    na, nb = len(ca), len(cb)
+    while i < na and j < nb:
+        x, y = ca[i][0], cb[j][0]
+        if x == y:
+            out.append((x, ca[i][1], cb[j][1]))
+            i += 1
+            j += 1
+        elif x < y:
+            out.append((x, ca[i][1], None))
+            i += 1
+        else:
+            out.append((y, None, cb[j][1]))
+            j += 1
+    out.extend((x, c, None) for x, c in ca[i:])
+    out.extend((y, None, c) for y, c in cb[j:])
+    return out
+
+
+def _first(pair):
+    return pair[0]
+
+
+def format_delta(delta):
+    return ('+' if delta >= 0 else '-') + format_bytes(abs(delta))
@@ -0,0 +1,212 @@
+"""
+exclusion rules, compiled once per scan
+
+- exclude-dirs: bare names exclude every directory with that name; entries
+  containing a path separator exclude that directory (resolved with realpath)
+- exclude-files: exact entry names
+- exclude-filters: substrings of entry names
+- exclude-patterns: .gitignore-style patterns (globs, `**`, trailing `/` for
+  directories only, leading or inner `/` to anchor at the scan root, `!` to
+  re-include). unlike git, negations win regardless of rule order.
+
+every lookup is a set membership test or a match against one combined regex
+per rule kind, so the per-entry cost does not grow with the number of rules.
+"""
+import os
+import re
+
+
+class ExclusionRules(object):
+    def __init__(self,
+                 exclude_dirs=[],
+                 exclude_files=[],
+                 exclude_filters=[],
+                 exclude_patterns=[],
+                 root=None):
+        # directory descent stops at the first excluded directory, so an exact
+        # match on realpath covers everything below it - the prefix trie
+        # collapses to a set, plus one walk up the ancestors of the scan root
+        self.dir_paths = set()
+        self.dir_names = set()
+        for d in exclude_dirs:
+            if os.sep in d:
+                self.dir_paths.add(os.path.realpath(os.path.expanduser(d)))
+            else:
+                self.dir_names.add(d)
+        self.names = set(exclude_files)
+
+        # name regex: substring filters and every unanchored, non-negated pattern
+        # (the common case) go into one alternation
+        self._name_re = None
+        name_parts = []
+        if exclude_filters:
+            name_parts.append('.*(?:%s).*' % '|'.join(re.escape(f) for f in exclude_filters))
+
+        # plain `*.ext` patterns are looked up by extension, literal names join
+        # exclude-files; the regex engine tries alternatives one at a time
+        self.extensions = set()
+        # remaining pattern kinds, keyed by (negated, dir_only, anchored)
+        grouped = {}
+        for line in exclude_patterns:
+            rule = parse_pattern(line)
+            if rule is None:
+                continue
+            negated, dir_only, anchored, body = rule
+            if not (negated or dir_only or anchored):
+                literal = body[1:] if body.startswith('*') else body
+                if _glob_chars.search(literal) is None:
+                    if literal is body:
+                        self.names.add(body)
+                        continue
+                    if literal.startswith('.') and literal.count('.') == 1:
+                        self.extensions.add(literal)
+                        continue
+                name_parts.append(_translate(body))
+            else:
+                grouped.setdefault((negated, dir_only, anchored), []).append(_translate(body))
+        if name_parts:
+            self._name_re = _combine(name_parts)
+        self._patterns = [(key, _combine(parts)) for key, parts in grouped.items()]
+        self._anchored = any(key[2] for key, _ in self._patterns)
+
+        self.root = None
+        if root is not None:
+            self.root = os.path.realpath(root).rstrip(os.sep) + os.sep
+
+    def __bool__(self):
+        return bool(self.dir_paths or self.dir_names or self.names or self.extensions or
+                    self._name_re or self._patterns)
+
+    def root_excluded(self, realpath):
+        """for the scan root only: is it inside an excluded directory?"""
+        if not self.dir_paths:
+            return False
+        path = realpath
+        while True:
+            if path in self.dir_paths:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def dir_excluded(self, name, realpath):
+        """directories that are kept in the tree, but not descended into"""
+        return name in self.dir_names or realpath in self.dir_paths
+
+    def excluded(self, name, real_prefix, is_dir):
+        """
+        entries that are dropped from the tree entirely. real_prefix is the
+        resolved path of the containing directory, with a trailing separator.
+        """
+        if name in self.names:
+            if not self._patterns or not self._match(True, name, real_prefix, is_dir):
+                return True
+        if self.extensions and name[name.rfind('.'):] in self.extensions:
+            if not self._patterns or not self._match(True, name, real_prefix, is_dir):
+                return True
+        if self._name_re is not None and self._name_re.match(name):
+            if not self._patterns or not self._match(True, name, real_prefix, is_dir):
+                return True
+        if self._patterns:
+            return (self._match(False, name, real_prefix, is_dir) and
+                    not self._match(True, name, real_prefix, is_dir))
+        return False
+
+    def _match(self, negated, name, real_prefix, is_dir):
+        rel = None
+        if self._anchored and self.root is not None and real_prefix.startswith(self.root):
+            rel = (real_prefix + name)[len(self.root):]
+            if os.sep != '/':
+                rel = rel.replace(os.sep, '/')
+        for (neg, dir_only, anchored), regex in self._patterns:
+            if neg != negated or (dir_only and not is_dir):
+                continue
+            if anchored:
+                if rel is not None and regex.match(rel):
+                    return True
+            elif regex.match(name):
+                return True
+        return False
+
+
+def parse_pattern(line):
+    """
+    split one .gitignore line into (negated, dir_only, anchored, glob),
+    or None for blank lines and comments
+    """
+    line = line.rstrip('\n').rstrip(' ')
+    if not line or line.startswith('#'):
+        return None
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    elif line.startswith('\\'):
+        # escaped leading ! or #
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if not line:
+        return None
+    return negated, dir_only, anchored, line
+
+
+def load_patterns(path):
+    """read a .gitignore-style file"""
+    with open(os.path.expanduser(path)) as f:
+        return f.read().splitlines()
+
+
+_glob_chars = re.compile(r'[*?\[\\]')
+
+
+def _combine(parts):
+    return re.compile('(?:%s)\\Z' % '|'.join(parts), re.S)
+
+
+def _translate(pattern):
+    """gitignore glob -> regex source, matched against a '/'-separated path"""
+    segments = pattern.split('/')
+    out = []
+    for n, seg in enumerate(segments):
+        last = n == len(segments) - 1
+        if seg == '**':
+            # any number of directories, or everything inside when trailing
+            out.append('.*' if last else '(?:[^/]*/)*')
+            continue
+        out.append(_translate_segment(seg))
+        if not last:
+            out.append('/')
+    return ''.join(out)
+
+
+def _translate_segment(seg):
+    out = []
+    i = 0
+    while i < len(seg):
+        c = seg[i]
+        i += 1
+        if c == '*':
+            while i < len(seg) and seg[i] == '*':
+                i += 1
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '\\' and i < len(seg):
+            out.append(re.escape(seg[i]))
+            i += 1
+        elif c == '[':
+            j = seg.find(']', i + 1 if i < len(seg) and seg[i] in '!^' else i)
+            if j < 0:
+                out.append('\\[')
+                continue
+            body = seg[i:j]
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            out.append('[%s]' % body.replace('\\', '\\\\'))
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
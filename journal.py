@@ -0,0 +1,198 @@
+"""
+checkpointed scans: every directory listing is appended to a journal file as
+soon as it is read, so an interrupted scan can be resumed
+
+the journal is json lines. the first line describes the scan (root, options,
+root identity); each following line is one listed directory:
+    [path, realpath, details, entries]
+with one entry per child, [name, kind code, size, details] plus
+[mtime, inode, st_dev] for subdirectories that were listed (or still need
+to be). details are 0 for none. a directory's line is always written after
+its parent's, and a line cut short by a crash is ignored on resume.
+
+while scanning, only the directories still to be listed are kept in memory;
+the tree is built from the journal at the end, one line at a time.
+"""
+import json
+import os
+import time
+
+from logger import logger
+from scan import DIRECTORY, KIND_CODES, KINDS, DirectoryNode, ScanOptions, TreeNode, _list_dir, _scan_root
+
+
+VERSION = 1
+# journal lines written between flushes to the OS
+FLUSH_EVERY = 256
+
+
+def scan_directory_tree_journaled(path,
+                                  journal_path,
+                                  resume=False,
+                                  exclude_dirs=[],
+                                  exclude_files=[],
+                                  exclude_filters=[],
+                                  skip_mount=False,
+                                  slow_details=False,
+                                  exclude_patterns=[],
+                                  exclude_root=None,
+                                  progress=None,
+                                  file_keys=False):
+    """
+    scan_directory_tree, journaled to journal_path. with resume, directories
+    already in the journal are not listed again. the journal is removed once
+    the tree has been built.
+    """
+    t0 = time.time()
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, slow_details,
+                       exclude_patterns, exclude_root or path, file_keys)
+    root, realpath, dev = _scan_root(path, opts)
+    if dev is None:
+        return root
+
+    header = {
+        'journal': VERSION,
+        'root': path,
+        'realpath': realpath,
+        'mtime': root.mtime,
+        'inode': root.inode,
+        'dev': dev,
+        'options': [exclude_dirs, exclude_files, exclude_filters, skip_mount, exclude_patterns],
+    }
+    listed = {}
+    if resume:
+        listed = _resume_state(journal_path, header)
+    mode = 'a' if listed else 'w'
+    if resume and not listed:
+        logger.info('nothing to resume in %s, starting a new scan' % journal_path)
+
+    os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+    with open(journal_path, mode) as f:
+        if not listed:
+            f.write(json.dumps(header) + '\n')
+        try:
+            _journal_walk(f, path, realpath, dev, listed, opts, progress)
+        except BaseException:
+            logger.error('scan of %s interrupted, run again with --resume to continue from %s' % (path, journal_path))
+            raise
+
+    t = _build_tree(journal_path, root)
+    os.remove(journal_path)
+    logger.info('%f sec to scan %s with journal %s' % (time.time() - t0, path, journal_path))
+    return t
+
+
+def _journal_walk(f, path, realpath, dev, listed, opts, progress):
+    """list every directory below path that is not in listed, appending each to f"""
+    stack = [(path, realpath, dev)]
+    unflushed = 0
+    try:
+        while stack:
+            path, realpath, dev = stack.pop()
+            subdirs = listed.pop(path, None)
+            if subdirs is None:
+                subdirs = _list_and_record(f, path, realpath, dev, opts, progress)
+                unflushed += 1
+                if unflushed >= FLUSH_EVERY:
+                    f.flush()
+                    unflushed = 0
+            stack.extend(reversed(subdirs))
+    finally:
+        opts.long_dirs.close()
+
+
+def _list_and_record(f, path, realpath, dev, opts, progress):
+    # a throwaway node: the listing goes to the journal, not into a tree
+    t = DirectoryNode(path)
+    subdirs = _list_dir(t, path, realpath, dev, opts)
+    devs = {id(child): child_dev for child, _, _, child_dev in subdirs}
+    entries = []
+    nbytes = 0
+    for c in t.children:
+        entry = [c.basename, KIND_CODES[c.kind], c.size, c._details or 0]
+        if id(c) in devs:
+            entry.extend([c.mtime, c.inode, devs[id(c)]])
+        entries.append(entry)
+        nbytes += c.size
+    f.write(json.dumps([path, realpath, t._details or 0, entries]) + '\n')
+    if progress:
+        with progress.lock:
+            progress.dirs += 1
+            progress.files += len(entries) - len(subdirs)
+            progress.bytes += nbytes
+    return [(child_path, child_realpath, child_dev) for _, child_path, child_realpath, child_dev in subdirs]
+
+
+def _resume_state(journal_path, header):
+    """
+    {path: subdirectories} for every directory already in the journal, or
+    {} if there is no usable journal for this scan
+    """
+    listed = {}
+    try:
+        f = open(journal_path)
+    except FileNotFoundError:
+        return listed
+    with f:
+        first = _read_line(f.readline())
+        if first is None or any(first.get(k) != header[k] for k in ('journal', 'root', 'realpath', 'options')):
+            logger.warning('journal %s is for a different scan, ignoring it' % journal_path)
+            return {}
+        good = f.tell()
+        for line in iter(f.readline, ''):
+            record = _read_line(line)
+            if record is None:
+                break
+            path, realpath, _, entries = record
+            prefix = path + os.sep
+            real_prefix = realpath.rstrip(os.sep) + os.sep
+            listed[path] = [(prefix + e[0], real_prefix + e[0], e[6]) for e in entries if len(e) > 4]
+            good = f.tell()
+    # drop a partial last line, so appended lines start on a line of their own
+    with open(journal_path, 'r+') as f:
+        f.truncate(good)
+    logger.info('resuming scan from %s: %d directories already listed' % (journal_path, len(listed)))
+    return listed
+
+
+def _read_line(line):
+    if not line.endswith('\n'):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _build_tree(journal_path, root):
+    """the tree for a complete journal, below the already classified root"""
+    # directories whose own line hasn't been read yet
+    pending = {root.path: root}
+    dirs = []
+    with open(journal_path) as f:
+        f.readline()
+        for line in f:
+            path, _, details, entries = json.loads(line)
+            t = pending.pop(path)
+            if details:
+                t.details = details
+            children = []
+            prefix = path + os.sep
+            for entry in entries:
+                name, kind, size, child_details = entry[:4]
+                kind = KINDS[kind]
+                if kind == DIRECTORY:
+                    child = DirectoryNode(name, size, t)
+                    if len(entry) > 4:
+                        child.mtime, child.inode = entry[4], entry[5]
+                        pending[prefix + name] = child
+                else:
+                    child = TreeNode(name, size, t, kind)
+                if child_details:
+                    child.details = child_details
+                children.append(child)
+            t.children = children
+            dirs.append(t)
+    for t in reversed(dirs):
+        t.size = sum(c.size for c in t.children)
+    return root
@@ -0,0 +1,206 @@
+"""
+text line counts for every file in a scanned tree, for the `lines` size mode
+
+lines are counted by scanning fixed-size binary buffers for newlines (no
+decoding, no per-line objects), in a process pool. a file whose first
+buffer contains a NUL byte is treated as binary and gets no count.
+
+counts are cached on disk per path, with the file's (st_dev, st_ino,
+st_size, st_mtime_ns), so a repeat scan only reads files that changed since
+the previous one. scans run with file_keys=True leave that identity in each
+file's details['key'], so no file is stat'ed a second time here; other
+trees (archives, the columnar store) are lstat'ed.
+
+after add_line_counts, every file node has details['lines'] (0 for binary
+or unreadable files) and every directory has the total of its children.
+"""
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import stat
+import time
+
+from logger import logger
+
+
+BUFFER_SIZE = 1 << 20
+# files per task sent to a worker process
+BATCH_SIZE = 256
+# below this many uncached files, the pool costs more than it saves
+MIN_PARALLEL = 64
+
+DEFAULT_CACHE_PATH = '~/.cache/treemonger/linecounts.json'
+# workers are started fresh rather than forked: the caller may be the tk
+# background scan thread, and forking a threaded process is unsafe
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def file_key(st):
+    """identity of a file's contents, from its stat result"""
+    return '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def count_lines(path, buffer_size=BUFFER_SIZE):
+    """
+    number of lines in a text file, as len(f.readlines()) would count them,
+    or None for a binary file
+    """
+    lines = 0
+    last = b'\n'
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        first = True
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            if first:
+                if b'\0' in chunk:
+                    return None
+                first = False
+            lines += buf.count(b'\n', 0, n)
+            last = chunk[n - 1:n].tobytes()
+    if last != b'\n':
+        # final line without a trailing newline
+        lines += 1
+    return lines
+
+
+def _count_batch(paths):
+    """worker side: line count (or None) for each path"""
+    counts = []
+    for path in paths:
+        try:
+            counts.append(count_lines(path))
+        except OSError:
+            counts.append(None)
+    return counts
+
+
+class LineCountCache(object):
+    """
+    persistent map of path -> (file_key, line count), stored as one json
+    file. prune() drops the paths below a scanned root that the scan no
+    longer saw; entries outside it are kept, so scanning one subtree doesn't
+    evict the cache for the rest of the disk.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = os.path.expanduser(path) if path else None
+        self.counts = {}
+        self.dirty = False
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    counts = json.load(f)
+            except (OSError, ValueError) as exc:
+                logger.warning('ignoring unreadable line count cache %s: %s' % (self.path, exc))
+            else:
+                if all(type(v) is list for v in counts.values()):
+                    self.counts = counts
+                else:
+                    # keyed by file identity alone, before entries could be pruned
+                    logger.info('discarding line count cache %s in the old format' % self.path)
+                    self.dirty = True
+
+    def get(self, path, key):
+        """line count (None for binary files), or -1 if path is not cached with that key"""
+        entry = self.counts.get(path)
+        if entry is None or entry[0] != key:
+            return -1
+        return entry[1]
+
+    def set(self, path, key, lines):
+        self.counts[path] = [key, lines]
+        self.dirty = True
+
+    def prune(self, root, seen):
+        """drop the cached paths below root that are not in seen"""
+        prefix = root.rstrip(os.sep) + os.sep
+        stale = [p for p in self.counts if p.startswith(prefix) and p not in seen]
+        for p in stale:
+            del self.counts[p]
+        if stale:
+            self.dirty = True
+        return len(stale)
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.counts, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def add_line_counts(t, cache_path=DEFAULT_CACHE_PATH, processes=None):
+    """fill details['lines'] for every node in t, see module docstring"""
+    t0 = time.time()
+    cache = LineCountCache(cache_path)
+
+    # files first, parents before children; directories are summed in reverse.
+    # paths are built on the way down, not from each node's parent chain
+    files = []
+    dirs = []
+    stack = [(t, t.path)]
+    while stack:
+        node, path = stack.pop()
+        if node.children:
+            dirs.append(node)
+            prefix = path.rstrip(os.sep) + os.sep
+            stack.extend((c, prefix + c.basename) for c in node.children)
+        elif node.inode is None and 'skip' not in node.details:
+            files.append((node, path))
+        else:
+            # empty or unlisted directory, symlink, unreadable entry
+            node.details['lines'] = 0
+
+    misses = []
+    for node, path in files:
+        key = node.details.pop('key', None)
+        if key is None:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                node.details['lines'] = 0
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                node.details['lines'] = 0
+                continue
+            key = file_key(st)
+        lines = cache.get(path, key)
+        if lines == -1:
+            misses.append((node, path, key))
+        else:
+            node.details['lines'] = lines or 0
+
+    paths = [path for _, path, _ in misses]
+    if len(misses) < MIN_PARALLEL or processes == 1:
+        counts = _count_batch(paths)
+    else:
+        batches = [paths[n:n + BATCH_SIZE] for n in range(0, len(paths), BATCH_SIZE)]
+        counts = []
+        context = multiprocessing.get_context(_START_METHOD)
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as pool:
+            for batch_counts in pool.map(_count_batch, batches):
+                counts.extend(batch_counts)
+    for (node, path, key), lines in zip(misses, counts):
+        cache.set(path, key, lines)
+        node.details['lines'] = lines or 0
+    if t.children:
+        cache.prune(t.path, {path for _, path in files})
+
+    for node in reversed(dirs):
+        node.details['lines'] = sum(c.details['lines'] for c in node.children)
+
+    try:
+        cache.save()
+    except OSError as exc:
+        logger.warning('could not save line count cache %s: %s' % (cache.path, exc))
+    logger.info('%f sec to count lines: %d files, %d cached, %d lines' %
+                (time.time() - t0, len(files), len(files) - len(misses), t.details['lines']))
+    return t
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+questions about a saved scan store (see store.py), answered from its indexes
+
+./query.py STORE largest [--prefix=/path] [--limit=100]   # largest files
+./query.py STORE dirs --min-size=10G [--prefix=/path]     # directories of at least that size
+./query.py STORE extensions [--prefix=/path]              # count and bytes per extension
+"""
+import argparse
+
+from store import extension_totals, large_directories, largest_files, open_store
+from utils import format_bytes
+
+
+_units = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40, 'p': 1 << 50}
+
+
+def parse_size(s):
+    """bytes for '123', '10G', '1.5TB' (binary units)"""
+    s = s.strip().lower().rstrip('b')
+    unit = s[-1:] if s[-1:] in _units else ''
+    return int(float(s[:len(s) - len(unit)]) * _units[unit])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', help='scan store written with save-to-store')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('largest')
+    p.add_argument('--prefix')
+    p.add_argument('--limit', type=int, default=100)
+    p = sub.add_parser('dirs')
+    p.add_argument('--min-size', type=parse_size, default=parse_size('10G'))
+    p.add_argument('--prefix')
+    p.add_argument('--limit', type=int)
+    p = sub.add_parser('extensions')
+    p.add_argument('--prefix')
+    args = parser.parse_args()
+
+    db = open_store(args.store)
+    try:
+        if args.command == 'largest':
+            for path, size in largest_files(db, args.prefix, args.limit):
+                print('%10s  %s' % (format_bytes(size), path))
+        elif args.command == 'dirs':
+            for path, size in large_directories(db, args.min_size, args.prefix, args.limit):
+                print('%10s  %s' % (format_bytes(size), path))
+        elif args.command == 'extensions':
+            for ext, count, size in extension_totals(db, args.prefix):
+                print('%10s  %8d  %s' % (format_bytes(size), count, ext or '(none)'))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
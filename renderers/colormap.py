@@ -20,4 +20,23 @@ special_colors = {
         'color': ["#7f00bf", "#a040df", "#5f008f"],
         'text_color': "#ffffff",
     },
+    # growth size mode (scan diffs)
+    'grown': {
+        'color': ["#ff7f7f", "#ffbfbf", "#bf5f5f"],
+    },
+    'shrunk': {
+        'color': ["#7fdf7f", "#bfffbf", "#5f9f5f"],
+    },
+    'unchanged': {
+        'color': ["#bfbfbf", "#dfdfdf", "#9f9f9f"],
+    },
 }
+
+
+def growth_colors(delta):
+    """colors for a rect of a diff treemap: red for growth, green for shrinkage"""
+    if delta > 0:
+        return special_colors['grown']['color']
+    if delta < 0:
+        return special_colors['shrunk']['color']
+    return special_colors['unchanged']['color']
@@ -12,6 +12,6 @@ def render(rects):
         c = colormap[rect['depth']][0]
         xvec = [x, x+dx, x+dx, x, x]
         yvec = [y, y, y+dy, y+dy, y]
-        plt.plot(xvec, yvec, c)
+        plt.plot(xvec, yvec, c, linestyle='--' if rect.get('estimated') else '-')
 
     plt.show()
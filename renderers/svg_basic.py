@@ -6,7 +6,7 @@ no interactivity, no JavaScript.
 """
 
 import html
-from .colormap import colormap
+from .colormap import colormap, growth_colors
 from logger import logger
 
 
@@ -82,8 +82,10 @@ def render_rects(rects):
     body_parts = []
 
     for i, rect in enumerate(rects):
-        d = rect['depth'] % len(colormap)
-        cs = colormap[d]
+        if 'delta' in rect:
+            cs = growth_colors(rect['delta'])
+        else:
+            cs = colormap[rect['depth'] % len(colormap)]
 
         x = rect['x']
         y = rect['y']
@@ -98,10 +100,16 @@ def render_rects(rects):
             f'</clipPath>'
         )
 
-        # Rectangle
-        body_parts.append(
-            f'  <rect x="{x}" y="{y}" width="{dx}" height="{dy}" fill="{cs[0]}"/>'
-        )
+        # Rectangle; estimated sizes (budgeted scan) are drawn faded and dashed
+        if rect.get('estimated'):
+            body_parts.append(
+                f'  <rect x="{x}" y="{y}" width="{dx}" height="{dy}" fill="{cs[0]}"'
+                f' fill-opacity="0.5" stroke-dasharray="2,2"/>'
+            )
+        else:
+            body_parts.append(
+                f'  <rect x="{x}" y="{y}" width="{dx}" height="{dy}" fill="{cs[0]}"/>'
+            )
 
         # Highlight lines (top/left lighter, bottom/right darker)
         body_parts.append(
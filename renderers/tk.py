@@ -4,9 +4,13 @@ import mimetypes
 import os
 import shutil
 import sys
+import threading
 import time
 
+from aggregates import aggregates
 from logger import logger
+from scan import DIRECTORY, ScanProgress
+from transaction import TreeMismatch, TreeTransaction
 
 
 class TkTextHandler(logging.Handler):
@@ -40,7 +44,10 @@ import tkinter as tk
 from PIL import Image, ImageTk
 
 from utils import shorten, open_file, format_combo, get_mousebutton_names, format_bytes
-from .colormap import colormap, special_colors
+from .colormap import colormap, growth_colors, special_colors
+
+# members of a group of small files listed by the info action, largest first
+SMALL_FILES_INFO = 20
 
 # TODO: maybe the compute_rectangles function should add rect positions to the tree struct directly
 # then the mouse click hit test can retrieve the full struct directly
@@ -48,7 +55,7 @@ from .colormap import colormap, special_colors
 class TreemongerApp(object):
     queue = []
 
-    def __init__(self, master, title, scan_func, compute_func, config, width=None, height=None):
+    def __init__(self, master, title, scan_func, compute_func, config, width=None, height=None, watch_func=None):
         self.config = config
         self.action_map_mouse = self._parse_keycombos(config['mouse'])
         self.action_map_keyboard = self._parse_keycombos(config['keyboard'])
@@ -62,6 +69,7 @@ class TreemongerApp(object):
         # Store canvas item IDs for each rect path for fast partial updates
         # path -> {'rect_id': id, 'highlight_id': id, 'shadow_id': id, 'text_id': id}
         self.canvas_items = {}
+        self.rects = []
         # Track last hovered rect for keyboard actions when mouse isn't over canvas
         self._last_hovered_rect = None
 
@@ -73,11 +81,20 @@ class TreemongerApp(object):
         self._highlight_text_color = tk_conf.get('highlight_text_color', special_colors['highlight']['text_color'])
 
         self.scan_func = scan_func
-        self.tree = self.scan_func()
-        self.scan_root = self.tree.path
+        self.tree = None
+        self.scan_root = None
+        self.progress = None
+        self._progress_job = None
+
+        # optional live updates, see watch.py
+        self.watch_func = watch_func
+        self._watcher = None
+        self._watch_job = None
 
         self.compute_func = compute_func
         self.render_root = '/'  # walk up and down tree to zoom
+        # the group of small files zoomed into, when render_root names one (see subdivide.SmallFiles)
+        self._small_files = None
 
         self.master = master
         screen_width = master.winfo_screenwidth()
@@ -138,6 +155,14 @@ class TreemongerApp(object):
         # self._print_usage()
         self._print_help_shortcut()
 
+        if tk_conf.get('background_scan', True):
+            # show the window right away, and draw the tree as it is discovered
+            self._start_background_scan()
+        else:
+            self._set_tree(self.scan_func())
+            if self.watch_func:
+                self._start_watch()
+
     def _setup_status_bar(self):
         """Status bar: info on left, filter on right."""
         self.status_bar = tk.Frame(self.master)
@@ -193,30 +218,12 @@ class TreemongerApp(object):
         matching_paths = set()
         for rect in self.rects:
             path = rect['path']
-            is_dir = rect['type'] == 'directory'
-            if filter_text.startswith('.'):
-                # Extension filter (files only)
-                if not is_dir and path.endswith(filter_text):
-                    matching_paths.add(path)
-            elif filter_text.startswith(':'):
-                # MIME category filter (files only)
-                if not is_dir:
-                    category = filter_text[1:].lower()
-                    mime_type, _ = mimetypes.guess_type(path)
-                    if mime_type and mime_type.split('/')[0] == category:
-                        matching_paths.add(path)
-            elif filter_text.endswith('/'):
-                # Trailing slash: match directories only
-                if is_dir:
-                    query = filter_text[:-1].lower()
-                    dirname = os.path.basename(path)
-                    if query in dirname.lower():
-                        matching_paths.add(path)
-            else:
-                # Substring match on name (files and directories)
-                name = os.path.basename(path)
-                if filter_text.lower() in name.lower():
+            if rect['type'] == 'small_files':
+                # highlighted when any of the files it stands for matches
+                if any(_name_matches(filter_text, c.basename, _is_dir(c)) for c in rect['group'].children):
                     matching_paths.add(path)
+            elif _name_matches(filter_text, os.path.basename(path), rect['type'] == 'directory'):
+                matching_paths.add(path)
 
         self._apply_highlight(matching_paths)
 
@@ -247,33 +254,25 @@ class TreemongerApp(object):
             f"Filter: {filter_text} — {total_count} file{'s' if total_count != 1 else ''}, {format_bytes(total_bytes)} ({visible_count} visible)"))
 
     def _count_tree_matches(self, filter_text):
-        """Walk the full tree and count files/bytes matching the filter."""
+        """Count files/bytes in the full tree matching the filter."""
+        if not self.progress:
+            # extension and category totals come from the directory aggregates;
+            # a scan in progress has none yet
+            if filter_text.startswith('.') and filter_text.count('.') == 1:
+                # a single-dot suffix of a name is a suffix of its extension key
+                stats = aggregates(self.tree)
+                return _sum_totals(v for k, v in stats.extensions.items() if k.endswith(filter_text))
+            if filter_text.startswith(':'):
+                stats = aggregates(self.tree)
+                return _sum_totals(v for k, v in stats.categories().items() if k == filter_text[1:].lower())
+
         count = 0
         total = 0
         stack = [self.tree]
         while stack:
             node = stack.pop()
-            is_dir = bool(node.children)
-            name = os.path.basename(node.path)
-            matched = False
-            if filter_text.startswith('.'):
-                if not is_dir and node.path.endswith(filter_text):
-                    matched = True
-            elif filter_text.startswith(':'):
-                if not is_dir:
-                    category = filter_text[1:].lower()
-                    mime_type, _ = mimetypes.guess_type(node.path)
-                    if mime_type and mime_type.split('/')[0] == category:
-                        matched = True
-            elif filter_text.endswith('/'):
-                if is_dir:
-                    query = filter_text[:-1].lower()
-                    if query in name.lower():
-                        matched = True
-            else:
-                if filter_text.lower() in name.lower():
-                    matched = True
-            if matched:
+            # the basename is stored on the node, the full path would have to be rebuilt
+            if _name_matches(filter_text, node.basename, _is_dir(node)):
                 count += 1
                 total += node.size
             stack.extend(node.children)
@@ -298,8 +297,10 @@ class TreemongerApp(object):
         # Find the rect to get its depth
         for rect in self.rects:
             if rect['path'] == path:
-                d = (rect['depth'] + self._base_color_depth) % len(colormap)
-                cs = colormap[d]
+                if 'delta' in rect:
+                    cs = growth_colors(rect['delta'])
+                else:
+                    cs = colormap[(rect['depth'] + self._base_color_depth) % len(colormap)]
                 items = self.canvas_items[path]
                 self.canv.itemconfig(items['rect_id'], fill=cs[0])
                 self.canv.itemconfig(items['highlight_id'], fill=cs[1])
@@ -411,6 +412,9 @@ class TreemongerApp(object):
         return False
 
     def _render(self, width=None, height=None):
+        if self.tree is None:
+            # background scan hasn't published anything yet
+            return
         t0 = time.time()
         width = width or self.width
         height = height or self.height
@@ -427,9 +431,23 @@ class TreemongerApp(object):
             render_root = '/' + render_root
         if render_root != '/':
             parts = render_root.split('/')[1:]
-            for p in parts:
+            for i, p in enumerate(parts):
                 logger.trace('getting %s' % p)
-                render_tree = render_tree[p]
+                group = self._small_files
+                # == rather than is: columnar nodes are new facades on each access
+                if group is not None and group.parent == render_tree and p == group.basename:
+                    render_tree = group
+                    break
+                child = render_tree.child(p)
+                if child is None:
+                    # removed since it was zoomed into (by the watcher or a refresh):
+                    # zoom out to the deepest directory that is still there
+                    missing = len(parts) - i
+                    logger.info('%s is gone, zooming out %d level(s)' % (self.render_root, missing))
+                    self.render_root = '/'.join(self.render_root.split('/')[:-missing]) or '/'
+                    render_root = '/'.join(render_root.split('/')[:-missing]) or '/'
+                    break
+                render_tree = child
 
         zoom_depth = len(render_root.split('/')) - 1
         self._base_color_depth = zoom_depth
@@ -475,11 +493,19 @@ class TreemongerApp(object):
         elif is_highlighted:
             cs = self._highlight_color
             text_fill = self._highlight_text_color
+        elif 'delta' in rect:
+            cs = growth_colors(rect['delta'])
+            text_fill = "black"
         else:
             cs = colormap[d]
             text_fill = "black"
 
-        rect_id = self.canv.create_rectangle(x, y, x+dx, y+dy, width=1, fill=cs[0], outline='black')
+        if rect.get('estimated'):
+            # not actually scanned, see scan.scan_directory_tree_budgeted
+            rect_id = self.canv.create_rectangle(x, y, x+dx, y+dy, width=1, fill=cs[0], outline='black',
+                                                 stipple='gray50', dash=(2, 2))
+        else:
+            rect_id = self.canv.create_rectangle(x, y, x+dx, y+dy, width=1, fill=cs[0], outline='black')
         highlight_id = self.canv.create_line(x+1, y+dy-1, x+1, y+1, x+dx-1, y+1, fill=cs[1])
         shadow_id = self.canv.create_line(x+1, y+dy-1, x+dx-1, y+dy-1, x+dx-1, y+1, fill=cs[2])
 
@@ -487,7 +513,7 @@ class TreemongerApp(object):
             text_x = x + self.config['tk_renderer']['text_offset_x']
             text_y = y + self.config['tk_renderer']['text_offset_y']
             anchor = tk.NW
-        elif rect['type'] == 'file':
+        elif rect['type'] in ('file', 'small_files'):
             text_x = x + dx / 2
             text_y = y + dy / 2
             anchor = tk.CENTER
@@ -504,6 +530,87 @@ class TreemongerApp(object):
             'text_id': text_id,
         }
 
+    def _set_tree(self, tree):
+        self.tree = tree
+        self.scan_root = tree.path
+        self._tree_changed()
+
+    def _tree_changed(self):
+        """drop what was computed from the previous tree: cached layouts, and the group of small files zoomed into"""
+        self.compute_func.invalidate()
+        group = self._small_files
+        if group is None:
+            return
+        # its members may have changed, or belong to a replaced tree: zoom out to its directory
+        self._small_files = None
+        parts = self.render_root.split('/')
+        if parts[-1] == group.basename:
+            self.render_root = '/'.join(parts[:-1]) or '/'
+
+    def _start_background_scan(self):
+        progress = ScanProgress()
+        self.progress = progress
+
+        def run():
+            try:
+                tree = self.scan_func(progress=progress)
+            except Exception as exc:
+                logger.error('scan failed: %s' % exc)
+                progress.finish(None, error=exc)
+            else:
+                progress.finish(tree)
+
+        threading.Thread(target=run, daemon=True).start()
+        self._progress_job = self.master.after(100, self._progress_tick)
+
+    def _progress_tick(self):
+        """redraw the partial tree from a background scan, until it is done"""
+        progress = self.progress
+        if progress.tree is not None:
+            self._set_tree(progress.tree)
+        if progress.done:
+            self.progress = None
+            self._progress_job = None
+            if progress.error is not None:
+                self.set_status('Scan failed: %s' % progress.error)
+                return
+            self.set_status('Scanned %d files, %s in %.1f sec' %
+                            (progress.files, format_bytes(self.tree.size), progress.elapsed))
+            self._render()
+            if self.watch_func:
+                self._start_watch()
+            return
+
+        self.set_status('%s... %d files, %s (%.0f files/sec)' %
+                        (progress.stage, progress.files, format_bytes(progress.bytes), progress.files_per_sec))
+        if self.tree is not None:
+            self._render()
+        interval = self.config['tk_renderer'].get('progress_interval_ms', 500)
+        self._progress_job = self.master.after(interval, self._progress_tick)
+
+    def _start_watch(self):
+        """(re)attach the watcher to the current tree and start polling it"""
+        if self._watcher:
+            self._watcher.close()
+        self._watcher = self.watch_func(self.tree)
+        if not self._watch_job:
+            self._watch_job = self.master.after(0, self._watch_tick)
+
+    def _watch_tick(self):
+        if self._watcher is None:
+            # detached for a full rescan, reattached when it completes
+            self._watch_job = None
+            return
+        # scheduled first, so an error while applying or drawing doesn't stop the polling
+        interval = self.config['tk_renderer'].get('watch_interval_ms', 300)
+        self._watch_job = self.master.after(interval, self._watch_tick)
+        # events are applied in batches, so the canvas is re-laid-out at most once per tick
+        if self._watcher.poll():
+            self.tree = self._watcher.tree
+            self._tree_changed()
+            logger.debug('watch: tree changed, now %s' % format_bytes(self.tree.size))
+            self._render()
+
     def _find_rect(self, x, y, use_fallback=True):
         # TODO: it would be really nice if the rectangles and the tree nodes
         # were the same objects, so i could just traverse the tree right here...
@@ -514,6 +621,14 @@ class TreemongerApp(object):
         if use_fallback:
             return self._last_hovered_rect
 
+    def _find_path_rect(self, ev, action):
+        """the rect under the cursor, for actions on its path: not a group of small files"""
+        rect = self._find_rect(ev.x, ev.y)
+        if rect and rect['type'] == 'small_files':
+            logger.info('  %s: "%s" is a group, zoom in to pick a file' % (action, rect['path']))
+            return None
+        return rect
+
     def _check_zoom_cooldown(self):
         """Returns True if zoom should proceed, False if in cooldown."""
         now = time.time()
@@ -645,6 +760,7 @@ class TreemongerApp(object):
         m.add_command(label="open file", command=lambda: self.open_file(ev))
         m.add_command(label="open location", accelerator="o", command=lambda: self.open_location(ev))
         m.add_command(label="refresh", accelerator="r", command=lambda: self.refresh(ev))
+        m.add_command(label="full rescan", accelerator="shift+r", command=lambda: self.rescan(ev))
         m.add_separator()
         m.add_command(label="move to trash", accelerator="t", command=lambda: self.trash_path(ev))
         # m.add_separator()
@@ -674,12 +790,35 @@ class TreemongerApp(object):
         rect = self._find_rect(ev.x, ev.y)
         if rect:
             logger.info('  %s (%s)' % (rect['path'], rect['bytes']))
+            if rect['type'] == 'small_files':
+                members = sorted(rect['group'].children, key=_size, reverse=True)
+                for c in members[:SMALL_FILES_INFO]:
+                    logger.info('    %s (%s)' % (c.basename, format_bytes(c.size)))
+                if len(members) > SMALL_FILES_INFO:
+                    logger.info('    ... %d more' % (len(members) - SMALL_FILES_INFO))
 
     def refresh(self, ev):
-        self.tree = self.scan_func()
+        if self.progress:
+            logger.info('  refresh: scan still in progress')
+            return
+        # incremental: only directories that changed since the last scan are listed again
+        self.tree = self.scan_func(self.tree)
+        self._tree_changed()
         logger.trace('  refresh')
+        if self._watcher:
+            self._start_watch()
         self._render()
 
+    def rescan(self, ev):
+        if self.progress:
+            logger.info('  rescan: scan still in progress')
+            return
+        logger.trace('  rescan')
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+        self._start_background_scan()
+
     def zoom_top(self, ev):
         # zooming can be a slow UI operation, should have at least one info-level log for each zoom action
         if not self._check_zoom_cooldown():
@@ -719,6 +858,9 @@ class TreemongerApp(object):
         if len(parts2) > len(parts1):
             parts2 = parts2[:len(parts1)+1]  # zoom in one level
         self.render_root = '/'.join(parts2)
+        if rect['type'] == 'small_files' and len(parts2) == len(p2.split('/')):
+            # into the group itself, which _render can't find in the tree
+            self._small_files = rect['group']
         if self.render_root == old_render_root:
             logger.info("not zooming below leaf node")
             return
@@ -734,7 +876,7 @@ class TreemongerApp(object):
 
     def copy_path(self, ev):
         # https://unix.stackexchange.com/questions/139191/whats-the-difference-between-primary-selection-and-clipboard-buffer
-        rect = self._find_rect(ev.x, ev.y)
+        rect = self._find_path_rect(ev, 'copy_path')
         if not rect:
             return
         if pyperclip_present:
@@ -746,7 +888,7 @@ class TreemongerApp(object):
 
     def open_file(self, ev):
         """Open the file/directory with the system default application."""
-        rect = self._find_rect(ev.x, ev.y)
+        rect = self._find_path_rect(ev, 'open_file')
         if not rect:
             return
         logger.info('  open file: "%s"' % rect['path'])
@@ -765,7 +907,7 @@ class TreemongerApp(object):
         open_file(location)
 
     def add_to_queue(self, ev, action):
-        rect = self._find_rect(ev.x, ev.y)
+        rect = self._find_path_rect(ev, action)
         if not rect:
             return
         self.queue.append({
@@ -788,7 +930,7 @@ class TreemongerApp(object):
         self.queue = []
 
     def delete_tree(self, ev):
-        rect = self._find_rect(ev.x, ev.y)
+        rect = self._find_path_rect(ev, 'delete_tree')
         if not rect:
             return
         SAFE_MODE = True
@@ -801,20 +943,33 @@ class TreemongerApp(object):
         else:
             os.remove(rect['path'])
 
-        # TODO: don't rescan the whole tree, instead remove node directly
         # NOTE: this has to be SUPER robust, because one potential failure
         # mode is that the real file gets deleted, the app updates the render,
         # but does NOT update the canvas. then, the next delete event can delete
         # an unexpected file - BAD
-
-        #path = '/'.join(rect['path'].split('/')[1:])
-        #self.tree.delete_child(path)
-        #self._render()
-
-        self.refresh(ev)
+        # so: the node is only removed when the disk agrees it is gone, any
+        # mismatch falls back to a rescan, and _render redraws the whole canvas.
+        if self._remove_from_tree(rect['path']):
+            self._render()
+        else:
+            self.refresh(ev)
 
         logger.info('  delete_tree: %s' % rect['path'])
 
+    def _remove_from_tree(self, path):
+        """drop a deleted path from the tree, updating ancestor sizes. False if the tree can't be edited."""
+        if self.progress:
+            # the scanner is still building the tree
+            return False
+        try:
+            with TreeTransaction(self.tree) as tx:
+                tx.remove(path)
+        except TreeMismatch as exc:
+            logger.warning('  tree edit failed: %s' % exc)
+            return False
+        self._tree_changed()
+        return True
+
     def _mark_rect_as_trashed(self, path):
         """Fast partial update: visually mark a single rect as trashed without full re-render."""
         if path not in self.canvas_items:
@@ -830,7 +985,7 @@ class TreemongerApp(object):
 
     def trash_path(self, ev):
         """Move file/folder to system trash and visually mark as trashed."""
-        rect = self._find_rect(ev.x, ev.y)
+        rect = self._find_path_rect(ev, 'trash_path')
         if not rect:
             return
         path = rect['path']
@@ -863,6 +1018,11 @@ class TreemongerApp(object):
                     self._mark_rect_as_trashed(r['path'])
             logger.trace(f'  trash_path: marked children')
 
+            # correct the sizes of the ancestors without a rescan; the trashed
+            # rects stay on the canvas until the next render
+            if self._remove_from_tree(path):
+                logger.trace(f'  trash_path: removed from tree')
+
             # Log to file
             trash_log = self.config["trash-log-file"]
             if trash_log:
@@ -963,7 +1123,43 @@ class TreemongerApp(object):
         # Close hint
         tk.Label(content_frame, text="Esc to close", font=("Helvetica", 9, "italic"), fg="gray").pack(anchor="w", padx=10, pady=(15, 10))
 
-def init_app(scan_func, subdivide_func, config, title, width=None, height=None):
+def _name_matches(filter_text, name, is_dir):
+    """whether an entry matches the filter box text"""
+    if filter_text.startswith('.'):
+        # Extension filter (files only)
+        return not is_dir and name.endswith(filter_text)
+    if filter_text.startswith(':'):
+        # MIME category filter (files only)
+        if is_dir:
+            return False
+        mime_type, _ = mimetypes.guess_type(name)
+        return bool(mime_type) and mime_type.split('/')[0] == filter_text[1:].lower()
+    if filter_text.endswith('/'):
+        # Trailing slash: match directories only
+        return is_dir and filter_text[:-1].lower() in name.lower()
+    # Substring match on name (files and directories)
+    return filter_text.lower() in name.lower()
+
+
+def _is_dir(node):
+    return bool(node.children) or node.kind == DIRECTORY
+
+
+def _size(node):
+    return node.size
+
+
+def _sum_totals(pairs):
+    """(count, bytes) pairs -> total (count, bytes)"""
+    count = 0
+    total = 0
+    for n, size in pairs:
+        count += n
+        total += size
+    return count, total
+
+
+def init_app(scan_func, subdivide_func, config, title, width=None, height=None, watch_func=None):
     """
     similar to render_class, but accepts the original tree rather than the computed rectangles
     this allows recalculation on resize etc
@@ -990,6 +1186,6 @@ def init_app(scan_func, subdivide_func, config, title, width=None, height=None):
     root.iconphoto(True, icon)
 
 
-    app = TreemongerApp(root, title, scan_func, subdivide_func, config, width, height)
+    app = TreemongerApp(root, title, scan_func, subdivide_func, config, width, height, watch_func)
     app._render()
     root.mainloop()
@@ -1,5 +1,13 @@
+import collections
+import errno
 import os
+import stat
+import sys
+import threading
+import time
 
+from exclude import ExclusionRules
+from linecount import count_lines, file_key
 from logger import logger
 
 try:
@@ -14,25 +22,95 @@ except:
 from utils import format_bytes
 
 
+# longest path the kernel accepts in one syscall; deeper directories are
+# opened relative to an ancestor
+try:
+    _PATH_MAX = os.pathconf('/', 'PC_PATH_MAX')
+except (AttributeError, OSError, ValueError):
+    _PATH_MAX = 4096
+_NAME_MAX = 256
+
+
+# node kinds, recorded at scan time so that reading them costs no I/O
+FILE = 'file'
+DIRECTORY = 'directory'
+SYMLINK = 'symlink'
+OTHER = 'other'
+# kind <-> small integer, for the compact stores (columnar, archive). append only.
+KINDS = [None, FILE, DIRECTORY, SYMLINK, OTHER]
+KIND_CODES = {k: n for n, k in enumerate(KINDS)}
+
+
 class TreeNode(object):
-    def __init__(self, path, size=0):
-        self.path = path
+    """
+    one filesystem entry. only the last path component is stored, and the
+    full path is rebuilt from the parent chain on demand; a node without a
+    parent (the scan root) keeps the path it was created with. entries with
+    no children share an empty tuple, and details is created on first write.
+    """
+
+    __slots__ = ('_name', 'parent', 'size', 'children', '_details', 'kind')
+
+    # only directories store these, see DirectoryNode
+    mtime = None
+    inode = None
+    stats = None
+
+    def __init__(self, path, size=0, parent=None, kind=None):
+        # a full path for a root node, the bare name below a parent
+        self._name = path
+        self.parent = parent
         self.size = size
-        self.children = []
-        self.details = {}
+        self.children = ()
+        self._details = None
+        self.kind = kind
+
+    @property
+    def path(self):
+        node = self
+        parts = []
+        while node.parent is not None:
+            parts.append(node._name)
+            node = node.parent
+        parts.append(node._name)
+        return os.sep.join(reversed(parts))
+
+    @property
+    def basename(self):
+        if self.parent is None:
+            return os.path.basename(self._name)
+        return self._name
 
     @property
     def name(self):
-        name = os.path.basename(self.path)
-        try:
-            if os.path.isdir(self.path.encode('utf8')):
-                name += os.sep
-        except UnicodeDecodeError as exc:
-            logger.error(exc)
-            import ipdb
-            ipdb.set_trace()
+        if self.kind is None:
+            # only trees loaded from archives that predate kinds
+            self.kind = DIRECTORY if self.children or os.path.isdir(self.path) else FILE
+        if self.kind == DIRECTORY:
+            return self.basename + os.sep
+        return self.basename
+
+    @property
+    def details(self):
+        if self._details is None:
+            # attached on the first write, see _NewDetails
+            return _NewDetails(self)
+        return self._details
 
-        return name
+    @details.setter
+    def details(self, details):
+        self._details = details
+
+    def _attach_details(self):
+        if self._details is None:
+            self._details = {}
+        return self._details
+
+    def set_parent(self, parent):
+        """attach a node that was created as a root (e.g. scanned on its own) below parent"""
+        if self.parent is None:
+            self._name = os.path.basename(self._name)
+        self.parent = parent
 
     def __str__(self):
         size = format_bytes(self.size)
@@ -48,58 +126,171 @@ class TreeNode(object):
         info = ', '.join(info_list)
         return '<TreeNode %s: %s>' % (self.name, info)
 
-    def __getitem__(self, key):
-        # get child by path
+    def child(self, name):
+        """child by basename, or None"""
         for c in self.children:
-            if key == c.name or key + '/' == c.name:
+            if name == c.basename:
                 return c
-        logger.error('failed to getitem: %s (%s)' % (key, self))
-        #print([c.name for c in self.children])
         return None
-    
-    def delete_child(self, key):
-        logger.debug('deleting child by key: %s' % key)
-        parts = key.split('/')
-        logger.debug('parts = %s' % parts)
-        if len(parts) == 1:
-            for n, c in enumerate(self.children):
-                if key == c.name or key + '/' == c.name:
-                    logger.trace(self.children)
-                    del self.children[n]
-                    logger.trace(self.children)
-                    break
-        else:
-            logger.debug(self.children)
-            logger.debug(parts[0])
-            logger.debug(self[parts[0]])
-            self[parts[0]].delete_child('/'.join(parts[1:]))
+
+    def __getitem__(self, key):
+        # get child by name, with or without the trailing separator
+        c = self.child(key.rstrip(os.sep))
+        if c is None:
+            logger.error('failed to getitem: %s (%s)' % (key, self))
+        return c
+
+    def add_child(self, node):
+        if not isinstance(self.children, list):
+            self.children = list(self.children)
+        self.children.append(node)
+
+    def remove_child(self, node):
+        self.children.remove(node)
+
+    def replace_child(self, old, new):
+        self.children[self.children.index(old)] = new
 
     def __repr__(self):
         return self.__str__()
 
 
+class _NewDetails(dict):
+    """
+    the details of a node that has none: an empty dict, and item assignment
+    also writes to a plain dict that is then attached to the node
+    (node._attach_details). walks that only read details then don't leave a
+    dict on every node visited. only item assignment reaches the node.
+    """
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        dict.__init__(self)
+        self.node = node
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.node._attach_details()[key] = value
+
+
+class DirectoryNode(TreeNode):
+    """
+    a TreeNode for a directory. mtime and inode identify the listing that
+    children came from, for incremental rescans; they stay None for
+    directories that were not listed. files, most of a tree, don't pay for them.
+
+    child lookups go through a name -> child dict, built on the first lookup.
+    it is tied to the children list it was built from: assigning a new list
+    (as the scanners do) discards it, and add/remove/replace_child keep it
+    current. other in-place edits of children must use those methods.
+    """
+    __slots__ = ('mtime', 'inode', '_index', 'stats')
+
+    def __init__(self, path, size=0, parent=None):
+        TreeNode.__init__(self, path, size, parent, DIRECTORY)
+        self.mtime = None
+        self.inode = None
+        self._index = None
+        # cached aggregates.DirStats
+        self.stats = None
+
+    def _names(self):
+        index = self._index
+        if index is None or index[0] is not self.children:
+            index = self._index = (self.children, {c.basename: c for c in self.children})
+        return index[1]
+
+    def child(self, name):
+        return self._names().get(name)
+
+    def add_child(self, node):
+        TreeNode.add_child(self, node)
+        self._names()[node.basename] = node
+
+    def remove_child(self, node):
+        TreeNode.remove_child(self, node)
+        self._names().pop(node.basename, None)
+
+    def replace_child(self, old, new):
+        TreeNode.replace_child(self, old, new)
+        names = self._names()
+        names.pop(old.basename, None)
+        names[new.basename] = new
+
+
 def print_directory_tree(t, L=0, max=3):
     """print to stdout"""
     if L < max:
         print('%s%s' % ('  ' * L, t))
-        if os.path.isdir(t.path):
+        if t.kind == DIRECTORY:
             for child in t.children:
                 print_directory_tree(child, L + 1)
 
 
+def node_chain(t, path):
+    """
+    return the list of nodes from t down to the node at path, or None if
+    path is not in the tree. one name lookup per path component, no I/O.
+    """
+    chain = [t]
+    root = t.path
+    if path == root:
+        return chain
+    prefix = root + os.sep
+    if not path.startswith(prefix):
+        return None
+    node = t
+    for part in path[len(prefix):].split(os.sep):
+        node = node.child(part)
+        if node is None:
+            return None
+        chain.append(node)
+    return chain
+
+
 def tree_to_dict(t):
+    # without recursion: scanned trees can be deeper than the recursion limit
+    root = _node_dict(t, t.path)
+    stack = [(t, root)]
+    while stack:
+        node, d = stack.pop()
+        for c in node.children:
+            cd = _node_dict(c, d['path'] + os.sep + c.basename)
+            d['children'].append(cd)
+            stack.append((c, cd))
+    return root
+
+
+def _node_dict(t, path):
     return {
-        'path': t.path,
+        'path': path,
         'size': t.size,
-        'details': t.details,
-        'children': [tree_to_dict(c) for c in t.children],
+        'kind': t.kind,
+        # a new dict where the node has none, not a _NewDetails that holds on to it
+        'details': t._details or {},
+        'children': [],
     }
 
 
-def dict_to_tree(d):
-    t = TreeNode(d['path'], d['size'])
+def dict_to_tree(d, parent=None):
+    t = _dict_node(d, parent)
+    stack = [(t, d)]
+    while stack:
+        node, d = stack.pop()
+        if d['children']:
+            node.children = [_dict_node(c, node) for c in d['children']]
+            stack.extend(zip(node.children, d['children']))
+    return t
+
+
+def _dict_node(d, parent):
+    path = d['path'] if parent is None else sys.intern(os.path.basename(d['path']))
+    kind = d.get('kind')
+    if kind == DIRECTORY:
+        t = DirectoryNode(path, d['size'], parent)
+    else:
+        t = TreeNode(path, d['size'], parent, kind)
     t.details = d['details']
-    t.children = [dict_to_tree(c) for c in d['children']]
     return t
 
 
@@ -122,23 +313,27 @@ def get_directory_tree(path,
 
     if os.path.islink(path):
         # symlink
+        t.kind = SYMLINK
         t.details['skip'] = 'symlink'
         return t
 
     if realpath == '/System/Volumes/Data':
         # hardcoding this because I don't know how to detect it
         logger.debug('skip macOS data volume secret link %s' % path)
+        t.kind = DIRECTORY
         t.details['skip'] = 'volume'
         return t
 
     if skip_mount and not (realpath == '/') and os.path.ismount(realpath):
         # different filesystem, probably don't want to scan
         logger.info('skip mount %s' % path)
+        t.kind = DIRECTORY
         t.details['skip'] = 'mount'
         return t
 
     elif os.path.isdir(path):
         # directory
+        t.kind = DIRECTORY
         if path.startswith('/proc'):
             import ipdb; ipdb.set_trace()
         for d in exclude_dirs:
@@ -165,6 +360,7 @@ def get_directory_tree(path,
                 logger.info('skipping %s' % (exc))
             return t
 
+        t.children = []
         for file in files:
             skip = False
             for filt in exclude_filters:
@@ -176,21 +372,738 @@ def get_directory_tree(path,
             if file in exclude_files:
                 continue
             subtree = get_directory_tree(
-                path + os.sep + file, exclude_dirs, exclude_files, exclude_filters)
+                path + os.sep + file, exclude_dirs, exclude_files, exclude_filters,
+                skip_mount, slow_details)
             if subtree:
+                subtree.set_parent(t)
                 t.children.append(subtree)
                 size += t.children[-1].size
 
     elif os.path.isfile(path):
         # file
+        t.kind = FILE
         size = os.path.getsize(path)
         if slow_details:
             t.details = get_file_details(path)
 
+    else:
+        t.kind = OTHER
+
     t.size = size
     return t
 
 
+class ScanOptions(object):
+    """exclusion rules and behavior flags shared by every directory in one scan"""
+    def __init__(self,
+                 exclude_dirs=[],
+                 exclude_files=[],
+                 exclude_filters=[],
+                 skip_mount=False,
+                 slow_details=False,
+                 exclude_patterns=[],
+                 exclude_root=None,
+                 file_keys=False):
+        rules = ExclusionRules(exclude_dirs, exclude_files, exclude_filters,
+                               exclude_patterns, exclude_root)
+        # None when there is nothing to exclude, so the scanners can skip the checks
+        self.rules = rules if rules else None
+        self.skip_mount = skip_mount
+        self.slow_details = slow_details
+        # leave linecount.file_key in each regular file's details, see add_line_counts
+        self.file_keys = file_keys
+        self.progress = None
+        self.long_dirs = _LongDirOpener()
+
+
+class ScanProgress(object):
+    """
+    shared between a scan running on a worker thread and the UI.
+
+    the scanner sets `tree` as soon as the root is known, and then only ever
+    attaches complete children lists and grows sizes bottom-up, so the UI
+    can lay out the partial tree at any time. the root is marked with
+    details['in_progress'] until finish() is called by whoever started the
+    scan, so that later stages (line counting) are covered too.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage = 'Scanning'
+        self.tree = None
+        self.done = False
+        self.error = None
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.t0 = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.t0
+
+    @property
+    def files_per_sec(self):
+        return self.files / max(self.elapsed, 1e-6)
+
+    def finish(self, tree, error=None):
+        if tree is not None:
+            tree.details.pop('in_progress', None)
+            self.tree = tree
+        self.error = error
+        self.done = True
+
+
+def scan_directory_tree(path,
+                        exclude_dirs=[],
+                        exclude_files=[],
+                        exclude_filters=[],
+                        skip_mount=False,
+                        slow_details=False,
+                        exclude_patterns=[],
+                        exclude_root=None,
+                        progress=None,
+                        file_keys=False):
+    """
+    os.scandir-based replacement for get_directory_tree, producing the same TreeNode tree.
+
+    file type comes from the dirent (DirEntry.is_symlink/is_dir), and each
+    entry gets at most one lstat (DirEntry.stat, cached). realpath and
+    ismount are only evaluated for the root: children extend their parent's
+    resolved path, and mount points are detected by a change in st_dev.
+
+    with a ScanProgress, the partial tree is published as it grows, see there.
+    with file_keys, regular files keep linecount.file_key of their lstat in
+    details['key'], for add_line_counts.
+    """
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, slow_details,
+                       exclude_patterns, exclude_root or path, file_keys)
+    opts.progress = progress
+    t, realpath, dev = _scan_root(path, opts)
+    if dev is not None:
+        try:
+            _scan_dir(t, path, realpath, dev, opts)
+        finally:
+            opts.long_dirs.close()
+    return t
+
+
+def scan_directory_tree_parallel(path,
+                                 exclude_dirs=[],
+                                 exclude_files=[],
+                                 exclude_filters=[],
+                                 skip_mount=False,
+                                 slow_details=False,
+                                 exclude_patterns=[],
+                                 exclude_root=None,
+                                 progress=None,
+                                 file_keys=False,
+                                 threads=8):
+    """
+    multi-threaded variant of scan_directory_tree, producing the same TreeNode tree.
+
+    each worker owns a deque of directories still to be listed: it pushes the
+    subdirectories it discovers and pops from the same end (depth-first, warm
+    dentry cache), and when it runs dry it steals from the opposite end of
+    another worker's deque. scandir and stat release the GIL, so this pays off
+    when the walk is bound by syscall latency (network volumes, cold NVMe).
+    sizes are rolled up bottom-up once every directory has been listed.
+    """
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, slow_details,
+                       exclude_patterns, exclude_root or path, file_keys)
+    opts.progress = progress
+    t, realpath, dev = _scan_root(path, opts)
+    if dev is not None:
+        walker = _ParallelWalker(opts, threads)
+        walker.run(t, path, realpath, dev)
+
+        if not progress:
+            # children before parents. (with progress, sizes are already
+            # final, and the UI may be reading the children lists)
+            for level in reversed(walker.levels):
+                for node in level:
+                    node.size = sum(c.size for c in node.children)
+    return t
+
+
+class _ParallelWalker(object):
+    def __init__(self, opts, threads):
+        self.opts = opts
+        self.threads = max(1, threads)
+        self.queues = [collections.deque() for _ in range(self.threads)]
+        # directories grouped by depth, for the bottom-up size pass
+        self.levels = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.errors = []
+
+    def run(self, t, path, realpath, dev):
+        self.levels.append([t])
+        self.pending = 1
+        self.queues[0].append((t, path, realpath, dev, ()))
+        workers = [threading.Thread(target=self._work, args=(n,), daemon=True)
+                   for n in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _next_task(self, n):
+        try:
+            return self.queues[n].pop()
+        except IndexError:
+            pass
+        # steal, starting from a different victim for each worker
+        for k in range(1, self.threads):
+            try:
+                return self.queues[(n + k) % self.threads].popleft()
+            except IndexError:
+                pass
+        return None
+
+    def _work(self, n):
+        try:
+            self._walk(n)
+        finally:
+            self.opts.long_dirs.close()
+
+    def _walk(self, n):
+        queue = self.queues[n]
+        while not self.done.is_set():
+            task = self._next_task(n)
+            if task is None:
+                # other workers are still listing, and may publish more work
+                time.sleep(0.0005)
+                continue
+            t, path, realpath, dev, ancestors = task
+            try:
+                subdirs = _list_dir(t, path, realpath, dev, self.opts, ancestors)
+            except Exception as exc:
+                self.errors.append(exc)
+                subdirs = []
+
+            if subdirs:
+                depth = len(ancestors) + 1
+                with self.lock:
+                    if len(self.levels) <= depth:
+                        self.levels.append([])
+                    self.levels[depth].extend(task[0] for task in subdirs)
+                    self.pending += len(subdirs)
+                ancestors += (t,)
+                for child_task in subdirs:
+                    queue.append(child_task + (ancestors,))
+
+            with self.lock:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.done.set()
+
+
+def scan_directory_tree_budgeted(path,
+                                 exclude_dirs=[],
+                                 exclude_files=[],
+                                 exclude_filters=[],
+                                 skip_mount=False,
+                                 slow_details=False,
+                                 exclude_patterns=[],
+                                 exclude_root=None,
+                                 progress=None,
+                                 file_keys=False,
+                                 time_budget=None,
+                                 entry_budget=None):
+    """
+    approximate scan_directory_tree that stops after time_budget seconds or
+    entry_budget directory entries, whichever comes first.
+
+    directories are listed breadth-first, so the budget is spent on the top
+    of the tree, where the big rectangles are. directories still waiting when
+    it runs out are kept without children, marked with details['estimated'],
+    and sized by DirectorySizeEstimate. their mtime is left unset, so an
+    incremental rescan lists them properly. estimating costs an lstat per
+    directory, so with a time_budget it gets ESTIMATE_SHARE of it on top:
+    directories still waiting after that get the average estimate.
+    """
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, slow_details,
+                       exclude_patterns, exclude_root or path, file_keys)
+    opts.progress = progress
+    t, realpath, dev = _scan_root(path, opts)
+    if dev is None:
+        return t
+
+    deadline = None if time_budget is None else time.time() + time_budget
+    queue = collections.deque([(t, path, realpath, dev, ())])
+    listed = []
+    entries = 0
+    try:
+        while queue:
+            if ((deadline is not None and time.time() >= deadline) or
+                    (entry_budget is not None and entries >= entry_budget)):
+                break
+            node, node_path, node_realpath, node_dev, ancestors = queue.popleft()
+            subdirs = _list_dir(node, node_path, node_realpath, node_dev, opts, ancestors)
+            listed.append(node)
+            entries += len(node.children)
+            if progress:
+                ancestors += (node,)
+            for child_task in subdirs:
+                queue.append(child_task + (ancestors,))
+    finally:
+        opts.long_dirs.close()
+
+    if queue:
+        logger.info('scan budget used up after %d entries, estimating %d directories' %
+                    (entries, len(queue)))
+        stat_deadline = None if time_budget is None else time.time() + time_budget * ESTIMATE_SHARE
+        estimate = DirectorySizeEstimate(listed, stat_deadline)
+        for node, node_path, _, _, ancestors in queue:
+            node.mtime = None
+            node.details['estimated'] = True
+            if stat_deadline is None or time.time() < stat_deadline:
+                size = estimate.size(node_path)
+            else:
+                size = estimate.average()
+            if progress:
+                with progress.lock:
+                    node.size += size
+                    for a in reversed(ancestors):
+                        a.size += size
+            else:
+                node.size = size
+
+    if not progress:
+        # breadth-first order, so children come after their parents
+        for node in reversed(listed):
+            node.size = sum(c.size for c in node.children)
+    return t
+
+
+# share of a scan's time budget spent estimating the directories it didn't list
+ESTIMATE_SHARE = 0.1
+
+
+class DirectorySizeEstimate(object):
+    """
+    size estimates for directories that were never listed, from the ones that were.
+
+    a directory's allocation (st_blocks, or st_size where blocks aren't
+    reported) grows with its number of entries. a sample of listed
+    directories gives entries per allocated byte and file bytes per entry;
+    an unlisted directory is estimated as its allocation times both. this
+    covers the directory's own files only, so deep unlisted subtrees come out
+    small - the treemap marks them as estimates. average() is the estimate
+    for a directory of the sample's mean allocation, without an lstat.
+    sampling stops at deadline (a time.time() value), if given.
+    """
+    sample_size = 1000
+
+    def __init__(self, listed, deadline=None):
+        step = max(1, len(listed) // self.sample_size)
+        entries = 0
+        allocated = 0
+        sampled = 0
+        for node in listed[::step]:
+            if deadline is not None and sampled and time.time() >= deadline:
+                break
+            alloc = self.allocated(node.path)
+            if alloc:
+                entries += len(node.children)
+                allocated += alloc
+                sampled += 1
+        self.entries_per_byte = entries / allocated if allocated else 0
+        self.mean_allocated = allocated / sampled if sampled else 0
+
+        nentries = 0
+        nbytes = 0
+        for node in listed:
+            nentries += len(node.children)
+            nbytes += sum(c.size for c in node.children if c.inode is None)
+        self.bytes_per_entry = nbytes / nentries if nentries else 0
+
+    @staticmethod
+    def allocated(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return 0
+        blocks = getattr(st, 'st_blocks', None)
+        return blocks * 512 if blocks else st.st_size
+
+    def size(self, path):
+        return int(self.allocated(path) * self.entries_per_byte * self.bytes_per_entry)
+
+    def average(self):
+        return int(self.mean_allocated * self.entries_per_byte * self.bytes_per_entry)
+
+
+def rescan_directory_tree(t,
+                          exclude_dirs=[],
+                          exclude_files=[],
+                          exclude_filters=[],
+                          skip_mount=False,
+                          slow_details=False,
+                          exclude_patterns=[],
+                          exclude_root=None,
+                          file_keys=False):
+    """
+    bring a tree from scan_directory_tree up to date, reusing unchanged subtrees.
+
+    every directory is lstat'ed, but only those whose mtime or inode differs
+    from the recorded value are listed again; all others keep their children
+    as-is. a directory mtime only changes when entries are added, removed or
+    renamed, so files that grew in place inside an otherwise unchanged
+    directory keep their old size until a full rescan.
+    """
+    opts = ScanOptions(exclude_dirs, exclude_files, exclude_filters, skip_mount, slow_details,
+                       exclude_patterns, exclude_root or t.path, file_keys)
+    try:
+        realpath = os.path.realpath(t.path)
+        st = os.lstat(t.path)
+    except Exception:
+        st = None
+    if st is None or t.inode is None or not stat.S_ISDIR(st.st_mode):
+        # root changed type, vanished, or was never listed
+        return scan_directory_tree(t.path, exclude_dirs, exclude_files, exclude_filters,
+                                   skip_mount, slow_details, exclude_patterns, exclude_root,
+                                   file_keys=file_keys)
+
+    try:
+        _rescan_dir(t, t.path, realpath, st.st_dev, st.st_mtime, st.st_ino, opts)
+    finally:
+        opts.long_dirs.close()
+    return t
+
+
+def _rescan_dir(t, path, realpath, dev, mtime, inode, opts):
+    """revisit a previously listed directory and everything below it"""
+    # directories still to revisit, with their current stat identity
+    todo = [(t, path, realpath, dev, mtime, inode)]
+    # every revisited directory, parents before children, for the size pass
+    visited = []
+    while todo:
+        t, path, realpath, dev, mtime, inode = todo.pop()
+        visited.append(t)
+        if mtime == t.mtime and inode == t.inode:
+            # same entries as last time, only subdirectories can have changed
+            real_prefix = realpath.rstrip(os.sep) + os.sep
+            prefix = path + os.sep
+            dir_fd = None
+            if len(path) + _NAME_MAX >= _PATH_MAX:
+                try:
+                    dir_fd = opts.long_dirs.open(path)
+                except OSError:
+                    continue
+            for child in t.children:
+                if child.inode is None:
+                    # file, or an entry that was skipped
+                    continue
+                name = child.basename
+                try:
+                    if dir_fd is None:
+                        st = os.lstat(prefix + name)
+                    else:
+                        st = os.lstat(name, dir_fd=dir_fd)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append((child, prefix + name, real_prefix + name,
+                                 st.st_dev, st.st_mtime, st.st_ino))
+            continue
+
+        logger.debug('rescanning changed directory %s' % path)
+        previous = {c.basename: c for c in t.children if c.inode is not None}
+        t.mtime = mtime
+        t.inode = inode
+        t.children = []
+        t.details.pop('skip', None)
+        t.details.pop('estimated', None)
+        reused = {}
+        for child, child_path, child_realpath, child_dev in _list_dir(t, path, realpath, dev, opts):
+            prev = previous.get(child.basename)
+            if prev is not None and prev.inode == child.inode:
+                # same directory as before, which may itself be unchanged
+                todo.append((prev, child_path, child_realpath, child_dev, child.mtime, child.inode))
+                reused[id(child)] = prev
+            else:
+                _scan_dir(child, child_path, child_realpath, child_dev, opts)
+        if reused:
+            t.children = [reused.get(id(c), c) for c in t.children]
+
+    for t in reversed(visited):
+        t.size = sum(c.size for c in t.children)
+        t.stats = None
+
+
+def _scan_root(path, opts):
+    """
+    classify the scan root. returns (node, realpath, st_dev), where st_dev is
+    None if the root is not a directory to descend into.
+    """
+    try:
+        realpath = os.path.realpath(path)
+        st = os.lstat(path)
+    except Exception as exc:
+        t = TreeNode(path)
+        t.details['skip'] = str(exc)
+        logger.info('skipping %s' % (exc))
+        return t, None, None
+
+    if stat.S_ISLNK(st.st_mode):
+        t = TreeNode(path, 0, None, SYMLINK)
+        t.details['skip'] = 'symlink'
+    elif stat.S_ISDIR(st.st_mode):
+        t = DirectoryNode(path)
+        if opts.skip_mount and not (realpath == '/') and os.path.ismount(realpath):
+            logger.info('skip mount %s' % path)
+            t.details['skip'] = 'mount'
+        elif opts.rules is not None and opts.rules.root_excluded(realpath):
+            t.details['skip'] = 'exclude_dir'
+        else:
+            t.mtime = st.st_mtime
+            t.inode = st.st_ino
+            if opts.progress:
+                t.details['in_progress'] = True
+                opts.progress.tree = t
+            return t, realpath, st.st_dev
+    elif stat.S_ISREG(st.st_mode):
+        t = TreeNode(path, st.st_size, None, FILE)
+        if opts.slow_details:
+            t.details = get_file_details(path)
+        if opts.file_keys:
+            t.details['key'] = file_key(st)
+    else:
+        t = TreeNode(path, 0, None, OTHER)
+    return t, None, None
+
+
+def _scan_dir(t, path, realpath, dev, opts):
+    """
+    list t and everything below it, depth-first with an explicit stack.
+
+    a directory's size is summed once its last subdirectory is done, so the
+    stack only holds the directories on the current path and the siblings
+    still waiting below them; depth is not limited by the recursion limit.
+    """
+    # the directories from t down to the current one, and for each of them
+    # the subdirectories not yet visited (reversed, so pop() keeps listing order)
+    ancestors = []
+    pending = []
+    task = (t, path, realpath, dev)
+    while True:
+        if task is not None:
+            node, node_path, node_realpath, node_dev = task
+            subdirs = _list_dir(node, node_path, node_realpath, node_dev, opts, ancestors)
+            subdirs.reverse()
+            ancestors.append(node)
+            pending.append(subdirs)
+        if pending[-1]:
+            task = pending[-1].pop()
+            continue
+        pending.pop()
+        node = ancestors.pop()
+        if not opts.progress:
+            node.size = sum(c.size for c in node.children)
+        if not pending:
+            break
+        task = None
+
+
+def _report_dir(progress, t, children, ancestors):
+    """
+    count a freshly listed directory, and add its file bytes to t and every
+    ancestor, nearest first: a reader on another thread then never sees a
+    directory larger than the sum of its children.
+    """
+    # iterate the scanner's own reference, not the published t.children
+    nfiles = 0
+    nbytes = 0
+    for c in children:
+        if c.inode is None:
+            nfiles += 1
+            nbytes += c.size
+    with progress.lock:
+        t.size += nbytes
+        for a in reversed(ancestors):
+            a.size += nbytes
+        progress.files += nfiles
+        progress.dirs += 1
+        progress.bytes += nbytes
+
+
+def _list_dir(t, path, realpath, dev, opts, ancestors=()):
+    """
+    populate t.children from one scandir pass. file sizes are filled in;
+    returns [(child, child_path, child_realpath, child_dev), ...] for the
+    subdirectories that still need to be listed. path is t.path, passed
+    down by the walkers rather than rebuilt from the parent chain each time.
+    ancestors are only needed with a ScanProgress.
+    """
+    entries, skip = _read_dir(path, realpath, opts)
+    if entries is None:
+        t.details['skip'] = skip
+        return []
+    return _list_entries(t, entries, path, realpath, dev, opts, ancestors)
+
+
+def _read_dir(path, realpath, opts):
+    """
+    (scandir entries, None) for a directory, or (None, skip reason) if it
+    is not listed. shared by every tree builder, as is _classify.
+    """
+    if realpath == '/System/Volumes/Data':
+        # hardcoding this because I don't know how to detect it
+        logger.debug('skip macOS data volume secret link %s' % path)
+        return None, 'volume'
+
+    try:
+        if len(path) + _NAME_MAX >= _PATH_MAX:
+            # the entries' paths may be too long for the kernel. DirEntry.stat
+            # goes through the same descriptor, which stays open until the
+            # next long directory is opened on this thread
+            target = opts.long_dirs.open(path)
+        else:
+            target = path
+        with os.scandir(target) as it:
+            return list(it), None
+    except Exception as exc:
+        if 'Library' not in path:
+            # apple permission errors under Library are too noisy to print each one
+            logger.info('skipping %s' % (exc))
+        return None, str(exc)
+
+
+def _classify(entries, path, realpath, dev, opts):
+    """
+    stat and classify the scandir entries of one directory, dropping
+    excluded ones. yields (name, kind, size, st, details): st is the lstat
+    result (None for symlinks and entries that couldn't be stat'ed), and
+    details a new dict with the reason an entry is skipped, or None. a
+    directory with no details is to be listed.
+    """
+    prefix = path + os.sep
+    real_prefix = realpath.rstrip(os.sep) + os.sep
+    rules = opts.rules
+    for entry in entries:
+        name = entry.name
+        if rules is not None and rules.excluded(name, real_prefix, entry.is_dir(follow_symlinks=False)):
+            continue
+        if entry.is_symlink():
+            yield name, SYMLINK, 0, None, {'skip': 'symlink'}
+            continue
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError as exc:
+            # vanished or unreadable between readdir and stat
+            logger.info('skipping %s' % (exc))
+            kind = DIRECTORY if entry.is_dir(follow_symlinks=False) else OTHER
+            yield name, kind, 0, None, {'skip': str(exc)}
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            if opts.skip_mount and st.st_dev != dev:
+                # different filesystem, probably don't want to scan
+                logger.info('skip mount %s' % (prefix + name))
+                yield name, DIRECTORY, 0, st, {'skip': 'mount'}
+            elif rules is not None and rules.dir_excluded(name, real_prefix + name):
+                yield name, DIRECTORY, 0, st, {'skip': 'exclude_dir'}
+            else:
+                yield name, DIRECTORY, 0, st, None
+        elif stat.S_ISREG(st.st_mode):
+            yield name, FILE, st.st_size, st, None
+        else:
+            yield name, OTHER, 0, st, None
+
+
+def _list_entries(t, entries, path, realpath, dev, opts, ancestors):
+    """second half of _list_dir: TreeNodes for the classified entries"""
+    # build the list locally and attach it once complete
+    children = []
+    subdirs = []
+    prefix = path + os.sep
+    real_prefix = realpath.rstrip(os.sep) + os.sep
+    for name, kind, size, st, details in _classify(entries, path, realpath, dev, opts):
+        # names repeat a lot across a tree (__init__.py, index.js, .git),
+        # interned they share one string object
+        name = sys.intern(name)
+        if kind == DIRECTORY:
+            child = DirectoryNode(name, 0, t)
+            if details is None:
+                child.mtime = st.st_mtime
+                child.inode = st.st_ino
+                subdirs.append((child, prefix + name, real_prefix + name, st.st_dev))
+        else:
+            child = TreeNode(name, size, t, kind)
+            if kind == FILE:
+                if opts.slow_details:
+                    child.details = get_file_details(prefix + name)
+                if opts.file_keys:
+                    child.details['key'] = file_key(st)
+        if details is not None:
+            child.details = details
+        children.append(child)
+
+    t.children = children
+    if opts.progress:
+        _report_dir(opts.progress, t, children, ancestors)
+    return subdirs
+
+
+class _LongDirOpener(threading.local):
+    """
+    opens directories whose paths are longer than PATH_MAX. the descriptor
+    of the last one is kept (per thread) as an anchor, and a path below it is
+    opened relative to it: a depth-first walk then makes the kernel resolve
+    one component per directory instead of the whole path.
+    """
+    def __init__(self):
+        self.path = None
+        self.fd = None
+
+    def open(self, path):
+        anchor = self.path
+        if (anchor is not None and path.startswith(anchor + os.sep) and
+                len(path) - len(anchor) < _PATH_MAX):
+            fd = os.open(path[len(anchor) + len(os.sep):],
+                         os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=self.fd)
+        else:
+            fd = _open_long_dir(path)
+        self.close()
+        self.path = path
+        self.fd = fd
+        return fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.path = None
+        self.fd = None
+
+
+def _open_long_dir(path):
+    """
+    open a directory whose path is longer than PATH_MAX, by walking to it
+    in pieces with openat(2). returns a file descriptor.
+    """
+    fd = None
+    rest = path
+    while rest:
+        if len(rest) < _PATH_MAX:
+            piece, rest = rest, ''
+        else:
+            cut = rest.rfind(os.sep, 0, _PATH_MAX)
+            if cut <= 0:
+                raise OSError(errno.ENAMETOOLONG, os.strerror(errno.ENAMETOOLONG), path)
+            piece, rest = rest[:cut], rest[cut + 1:]
+        try:
+            next_fd = os.open(piece, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        fd = next_fd
+    return fd
+
+
 def get_file_details(path):
     details = {}
     if _use_magic:
@@ -202,9 +1115,7 @@ def get_file_details(path):
 
 
 def get_line_count(path):
-    with open(path, 'r') as f:
-        content = f.readlines()
-    return len(content)
+    return count_lines(path) or 0
 
 
 if __name__ == '__main__':
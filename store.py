@@ -0,0 +1,180 @@
+"""
+scans as sqlite databases, for queries that shouldn't need the whole tree in memory
+
+one row per node, in breadth-first order (so a parent's id is always lower
+than its children's):
+    nodes(id, parent, name, path, size, kind, ext, details)
+kind is a scan.KIND_CODES code, ext the extension (aggregates.extension) of
+non-directory entries and NULL for directories, details json or NULL. the
+indexes cover the common questions: largest files or directories (kind,
+size), totals per extension (ext, size), and anything below a path prefix
+(path, as a range: every path below /a/b sorts between '/a/b/' and '/a/b0').
+a meta table holds the scan metadata, as in archives.
+
+the query functions return plain tuples; query.py is the command line for them.
+load_store rebuilds the TreeNode tree for rendering.
+"""
+import collections
+import json
+import os
+import sqlite3
+import time
+
+from aggregates import extension
+from logger import logger
+from scan import DIRECTORY, FILE, KIND_CODES, KINDS, DirectoryNode, TreeNode
+
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    ext TEXT,
+    details TEXT
+);
+"""
+# created after the bulk insert, which is much faster than keeping them current row by row
+INDEXES = """
+CREATE INDEX nodes_path ON nodes (path);
+CREATE INDEX nodes_parent ON nodes (parent);
+CREATE INDEX nodes_kind_size ON nodes (kind, size);
+CREATE INDEX nodes_ext_size ON nodes (ext, size);
+"""
+SQLITE_MAGIC = b'SQLite format 3\0'
+BATCH_SIZE = 10000
+
+_DIRECTORY_CODE = KIND_CODES[DIRECTORY]
+_FILE_CODE = KIND_CODES[FILE]
+
+
+def is_store(path):
+    """whether path is a sqlite file, rather than an archive"""
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def save_store(path, t, metadata=None):
+    """write t to a new database at path, through a temporary file"""
+    t0 = time.time()
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    try:
+        # a fresh file that is renamed into place: no rollback journal needed
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.executescript(SCHEMA)
+        with db:
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           [(k, json.dumps(v)) for k, v in (metadata or {}).items()])
+            rows = _rows(t)
+            while True:
+                batch = [row for _, row in zip(range(BATCH_SIZE), rows)]
+                if not batch:
+                    break
+                db.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            db.executescript(INDEXES)
+    finally:
+        db.close()
+    os.replace(tmp, path)
+    logger.info('%f sec to save scan store %s' % (time.time() - t0, path))
+
+
+def _rows(t):
+    # (node, its id, its path), breadth-first
+    queue = collections.deque([(t, 1, t.path)])
+    yield (1, None, t.path, t.path, t.size, KIND_CODES[t.kind], None, _details(t))
+    next_id = 2
+    while queue:
+        node, node_id, path = queue.popleft()
+        prefix = path.rstrip(os.sep) + os.sep
+        for c in node.children:
+            name = c.basename
+            child_path = prefix + name
+            kind = KIND_CODES[c.kind]
+            is_dir = c.kind == DIRECTORY or bool(c.children)
+            yield (next_id, node_id, name, child_path, c.size, kind,
+                   None if is_dir else extension(name), _details(c))
+            if c.children:
+                queue.append((c, next_id, child_path))
+            next_id += 1
+
+
+def _details(node):
+    return json.dumps(node._details) if node._details else None
+
+
+def open_store(path):
+    return sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+
+
+def load_store(path):
+    """(tree, metadata) from a store, like load_archive"""
+    t0 = time.time()
+    db = open_store(path)
+    try:
+        metadata = {k: json.loads(v) for k, v in db.execute('SELECT key, value FROM meta')}
+        # directories by id, until the end of the load
+        nodes = {}
+        t = None
+        for node_id, parent, name, size, kind, ext, details in db.execute(
+                'SELECT id, parent, name, size, kind, ext, details FROM nodes ORDER BY id'):
+            kind = KINDS[kind]
+            parent_node = nodes.get(parent)
+            if kind == DIRECTORY:
+                node = DirectoryNode(name, size, parent_node)
+            else:
+                node = TreeNode(name, size, parent_node, kind)
+            if ext is None:
+                nodes[node_id] = node
+            if details:
+                node.details = json.loads(details)
+            if parent_node is None:
+                t = node
+            elif parent_node.children:
+                parent_node.children.append(node)
+            else:
+                parent_node.children = [node]
+    finally:
+        db.close()
+    logger.info('%f sec to load scan store %s' % (time.time() - t0, path))
+    return t, metadata
+
+
+def _below(prefix):
+    """where clause and arguments for the paths strictly below prefix"""
+    if not prefix:
+        return '', []
+    prefix = prefix.rstrip(os.sep) + os.sep
+    # the next string after every prefix + '...'
+    end = prefix[:-1] + chr(ord(os.sep) + 1)
+    return ' AND path >= ? AND path < ?', [prefix, end]
+
+
+def largest_files(db, prefix=None, limit=100):
+    """[(path, size)] of the largest files below prefix, largest first"""
+    where, args = _below(prefix)
+    return db.execute('SELECT path, size FROM nodes WHERE kind = ?%s ORDER BY size DESC LIMIT ?' % where,
+                      [_FILE_CODE] + args + [limit]).fetchall()
+
+
+def large_directories(db, min_size, prefix=None, limit=None):
+    """[(path, size)] of the directories below prefix of at least min_size bytes, largest first"""
+    where, args = _below(prefix)
+    query = 'SELECT path, size FROM nodes WHERE kind = ? AND size >= ?%s ORDER BY size DESC' % where
+    if limit:
+        query += ' LIMIT %d' % limit
+    return db.execute(query, [_DIRECTORY_CODE, min_size] + args).fetchall()
+
+
+def extension_totals(db, prefix=None):
+    """[(extension, count, bytes)] over the non-directory entries below prefix, most bytes first"""
+    where, args = _below(prefix)
+    return db.execute('SELECT ext, COUNT(*), SUM(size) AS total FROM nodes WHERE ext IS NOT NULL%s '
+                      'GROUP BY ext ORDER BY total DESC' % where, args).fetchall()
@@ -1,3 +1,18 @@
+import bisect
+import collections
+import itertools
+import operator
+import os
+import threading
+
+try:
+    import numpy as np
+    numpy_present = True
+except ImportError:
+    numpy_present = False
+
+from diff import format_delta
+from logger import logger
 from utils import format_bytes
 
 """
@@ -9,7 +24,176 @@ https://github.com/laserson/squarify
 """
 
 
-def compute_rectangles(node, xlim, ylim, params, recurse_level=0, dir_level=0, rects=[]):
+# cached rects kept by a LayoutEngine, over all its cached layouts: a few
+# window-sized layouts. each rect is a dict with its own text and path
+# strings, about 900 bytes, so this is about 9MB. 0 turns the cache off.
+DEFAULT_MAX_CACHED_RECTS = 10000
+# largest resize (in either direction) served by scaling a cached layout
+SCALE_LIMIT = 1.1
+# the params that change a layout
+_LAYOUT_PARAMS = ('size_mode', 'min_box_size', 'max_filesystem_depth', 'text_size', 'dir_text_offset',
+                  'xpad', 'ypad')
+
+
+class LayoutEngine(object):
+    """
+    compute_rectangles with an output list that belongs to the engine: each
+    layout() call refills the list from the previous call on the same
+    thread, overwriting it in place, so repeated renders (resize, zoom)
+    don't reallocate it. the returned list is only valid until the next
+    layout() on that thread; threads have lists of their own.
+
+    layouts are also kept in an LRU cache keyed by node, node size, box and
+    the layout params, bounded by the total number of cached rects. nodes
+    are compared with ==, so a columnar facade created anew on each zoom
+    finds the layouts of the same entry. going
+    back to a view (zoom out, redraw after a filter, same window size again)
+    reuses the rects. a resize of a cached view is served by scaling its
+    rects when no split direction can flip: each layout records how far its
+    most square split box was from square, and the resize may not change
+    the aspect ratio by more than that. scaling keeps the padding of the
+    original size, so it is limited to small resizes (SCALE_LIMIT).
+    the tree may change without its size changing (a move, a rescan), so
+    whoever edits the tree must call invalidate().
+    """
+    def __init__(self, max_cached_rects=DEFAULT_MAX_CACHED_RECTS):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.max_cached_rects = max_cached_rects
+        # key -> _CachedLayout, least recently used first
+        self._cache = collections.OrderedDict()
+        self._cached_rects = 0
+        # (node, size, params) -> key of its latest layout, for resizes
+        self._latest = {}
+        self.hits = 0
+        self.scaled = 0
+        self.misses = 0
+
+    def layout(self, node, xlim, ylim, params):
+        """list of rect dicts for node in the box xlim x ylim"""
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = _RectBuffer()
+        if self.max_cached_rects <= 0:
+            buf.n = 0
+            compute_rectangles(node, list(xlim), list(ylim), params, rects=buf)
+            return buf.finish()
+        node_key = (node, node.size, tuple(params.get(k) for k in _LAYOUT_PARAMS))
+        key = node_key + (tuple(xlim), tuple(ylim))
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                rects = entry.rects
+                how = 'hit'
+            else:
+                rects = self._scale(node_key, xlim, ylim)
+                how = 'scaled'
+        if rects is not None:
+            self._log(how)
+            buf.items[:] = rects
+            return buf.items
+
+        buf.n = 0
+        buf.min_ratio = float('inf')
+        # compute_rectangles pads the top-level box in place
+        compute_rectangles(node, list(xlim), list(ylim), params, rects=buf)
+        rects = buf.finish()
+        with self._lock:
+            self.misses += 1
+            self._store(key, node_key, _CachedLayout(xlim, ylim, list(rects), buf.min_ratio))
+        self._log('miss')
+        return rects
+
+    __call__ = layout
+
+    def invalidate(self):
+        """forget all cached layouts, after the tree changed"""
+        with self._lock:
+            self._cache.clear()
+            self._latest.clear()
+            self._cached_rects = 0
+
+    def _scale(self, node_key, xlim, ylim):
+        entry = self._cache.get(self._latest.get(node_key))
+        if entry is None:
+            return None
+        sx = (xlim[1] - xlim[0]) / (entry.xlim[1] - entry.xlim[0])
+        sy = (ylim[1] - ylim[0]) / (entry.ylim[1] - entry.ylim[0])
+        if not (1 / SCALE_LIMIT <= sx <= SCALE_LIMIT and 1 / SCALE_LIMIT <= sy <= SCALE_LIMIT):
+            return None
+        if max(sx / sy, sy / sx) >= entry.min_ratio:
+            # some split box could turn from wide to tall or back
+            return None
+        self.scaled += 1
+        x0, y0 = entry.xlim[0], entry.ylim[0]
+        return [dict(r, x=xlim[0] + (r['x'] - x0) * sx, y=ylim[0] + (r['y'] - y0) * sy,
+                     dx=r['dx'] * sx, dy=r['dy'] * sy) for r in entry.rects]
+
+    def _store(self, key, node_key, entry):
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._cached_rects -= len(old.rects)
+        self._cache[key] = entry
+        self._latest[node_key] = key
+        self._cached_rects += len(entry.rects)
+        while self._cached_rects > self.max_cached_rects and len(self._cache) > 1:
+            old_key, old = self._cache.popitem(last=False)
+            self._cached_rects -= len(old.rects)
+            if self._latest.get(old_key[:3]) == old_key:
+                del self._latest[old_key[:3]]
+
+    def _log(self, how):
+        total = self.hits + self.scaled + self.misses
+        logger.debug('layout cache %s: %d hits, %d scaled, %d misses (%.0f%% reused), %d rects cached' %
+                     (how, self.hits, self.scaled, self.misses, 100.0 * (self.hits + self.scaled) / total,
+                      self._cached_rects))
+
+
+class _CachedLayout(object):
+    __slots__ = ('xlim', 'ylim', 'rects', 'min_ratio')
+
+    def __init__(self, xlim, ylim, rects, min_ratio):
+        self.xlim = tuple(xlim)
+        self.ylim = tuple(ylim)
+        self.rects = rects
+        # long side / short side of the most square box that was split
+        self.min_ratio = min_ratio
+
+
+class _RectBuffer(object):
+    """list-like append target that reuses the slots of a previous layout"""
+    __slots__ = ('items', 'n', 'min_ratio')
+
+    def __init__(self):
+        self.items = []
+        self.n = 0
+        self.min_ratio = float('inf')
+
+    def append(self, rect):
+        if self.n < len(self.items):
+            self.items[self.n] = rect
+        else:
+            self.items.append(rect)
+        self.n += 1
+
+    def note_split(self, w, h, min_box_size):
+        # the halves of a box below min_box_size are never drawn, whichever way it is split
+        short = min(w, h)
+        if short >= min_box_size and short > 0:
+            ratio = max(w, h) / short
+            if ratio < self.min_ratio:
+                self.min_ratio = ratio
+
+    def finish(self):
+        # shrinking only reallocates when the list drops below half its capacity
+        del self.items[self.n:]
+        return self.items
+
+
+def compute_rectangles(node, xlim, ylim, params, recurse_level=0, dir_level=0, rects=None):
     # this function has to handle 3 cases:
     #  - single file: return a single rect
     #  - full directory: return single rect, divide and recurse on child files
@@ -22,24 +206,39 @@ def compute_rectangles(node, xlim, ylim, params, recurse_level=0, dir_level=0, r
     # TODO: need to enforce append order of rects such that
     #       drawing in iteration order ensures proper z ordering
 
+    if rects is None:
+        rects = []
+
     if (dir_level > params['max_filesystem_depth'] or
         xlim[1] - xlim[0] < params['min_box_size'] or
         ylim[1] - ylim[0] < params['min_box_size'] or
-        type(node) is not list and 'hide' in node.details):
-        return
+        type(node) is not _Span and 'hide' in node.details):
+        return rects
 
-    if type(node) == list:
+    if type(node) is _Span:
         node_type = 'file_group'
+    elif type(node) is SmallFiles and recurse_level > 0:
+        # laid out on its own (zoomed in), it is a directory of its members
+        node_type = 'small_files'
     elif len(node.children) > 0:
         node_type = 'directory'
     else:
         node_type = 'file'
 
-    if node_type in ['directory', 'file']:
+    if node_type in ['directory', 'file', 'small_files']:
         # - define a box and text
         # - if directory, compute new padded bounds for child boxes
         txt = node.path if recurse_level == 0 else node.name
-        txt += ' (%s)' % format_bytes(node.size)
+        # budgeted scans leave some directories unlisted, with an estimated size
+        estimated = 'estimated' in node.details
+        if params['size_mode'] == 'lines':
+            txt += ' (%d lines)' % node.details.get('lines', 0)
+        elif params['size_mode'] == 'growth':
+            txt += ' (%s)' % format_delta(_delta(node))
+        else:
+            txt += ' (%s%s)' % ('~' if estimated else '', format_bytes(node.size))
+        if 'in_progress' in node.details:
+            txt += ' scanning...'
 
         rect = {'x': xlim[0] + 1,
                 'y': ylim[0] + 1,
@@ -51,7 +250,14 @@ def compute_rectangles(node, xlim, ylim, params, recurse_level=0, dir_level=0, r
                 'text': txt,
                 'type': node_type,
                 'path': node.path,
+                'estimated': estimated,
                 }
+        if params['size_mode'] == 'growth':
+            # colored by sign, see colormap.growth_colors
+            rect['delta'] = _delta(node)
+        if node_type == 'small_files':
+            # for the renderer to expand it, see SmallFiles
+            rect['group'] = node
         rects.append(rect)
 
         if node_type == 'directory':
@@ -66,59 +272,211 @@ def compute_rectangles(node, xlim, ylim, params, recurse_level=0, dir_level=0, r
         # - recurse on both halves
 
         if node_type == 'directory':
-            children = node.children
             subdir_level = 1
             if params['size_mode'] == 'bytes':
                 total_size = node.size
             if params['size_mode'] == 'count':
                 total_size = len(node.children)
+            if params['size_mode'] == 'lines':
+                total_size = _lines(node)
+            if params['size_mode'] == 'growth':
+                total_size = _growth(node)
         else:
             children = node
             subdir_level = 0
-            if params['size_mode'] == 'bytes':
-                total_size = sum([x.size for x in node])
             if params['size_mode'] == 'count':
                 total_size = len(node)
+            else:
+                total_size = node.total()
+
+        if total_size <= 0:
+            # nothing to divide, e.g. only empty files, or a directory still being scanned
+            return rects
+
+        if node_type == 'directory':
+            size_key = _size_keys.get(params['size_mode'], _bytes)
+            children = node.children
+            if params['size_mode'] != 'count':
+                children = _group_small(node, size_key, total_size, xlim[1] - xlim[0], ylim[1] - ylim[0],
+                                        params['min_box_size'])
+            if (numpy_present and len(children) >= KERNEL_MIN_CHILDREN and
+                    params['size_mode'] != 'count'):
+                # all the splits of a wide directory at once, see split_rectangles
+                sizes = np.fromiter(map(size_key, children), np.int64, len(children))
+                *boxes, min_ratio = split_rectangles(sizes, xlim, ylim, params['xpad'], params['ypad'],
+                                                     total_size, params['min_box_size'])
+                if type(rects) is _RectBuffer and min_ratio < rects.min_ratio:
+                    rects.min_ratio = min_ratio
+                for i, x0, x1, y0, y1 in zip(*[a.tolist() for a in boxes]):
+                    compute_rectangles(children[i], [x0, x1], [y0, y1], params, recurse_level + 1,
+                                       dir_level + 1, rects)
+                return rects
+            # children sorted once per directory, groups below are ranges of that order
+            children = _Span.of(children, size_key)
 
-        groupA, xA, yA, groupB, xB, yB = squarify(children, xlim, ylim, params['xpad'], params['ypad'], total_size=total_size)
+        if type(rects) is _RectBuffer:
+            # for LayoutEngine's resize check
+            rects.note_split(xlim[1] - xlim[0], ylim[1] - ylim[0], params['min_box_size'])
+        groupA, xA, yA, groupB, xB, yB = squarify(children, xlim, ylim, params['xpad'], params['ypad'],
+                                                  total_size=total_size)
 
         # recurse
         compute_rectangles(groupA, xA, yA, params, recurse_level + 1,
-                           dir_level + subdir_level)
+                           dir_level + subdir_level, rects)
         compute_rectangles(groupB, xB, yB, params, recurse_level + 1,
-                           dir_level + subdir_level)
+                           dir_level + subdir_level, rects)
 
     return rects
 
 
-def squarify(nodes, xlim, ylim, xpad, ypad, total_size):
+_bytes = operator.attrgetter('size')
+
+
+def _lines(node):
+    # filled in by linecount.add_line_counts
+    return node.details.get('lines', 0)
+
+
+def _growth(node):
+    # filled in by diff.diff_trees
+    return node.details.get('growth', 0)
+
+
+def _delta(node):
+    return node.details.get('delta', 0)
+
+
+_size_keys = {
+    'bytes': _bytes,
+    'lines': _lines,
+    'growth': _growth,
+}
+
+
+def _group_small(node, size_key, total_size, w, h, min_box_size):
+    """
+    node's children, with the ones whose share of the w x h box is below
+    min_box_size ** 2 merged into one SmallFiles. those could never get a
+    box at least min_box_size on each side, so laying them out one by one
+    is wasted work; the cost of the layout is then bounded by the number of
+    boxes that fit, plus one pass over the children here.
+    """
+    children = node.children
+    if w <= 0 or h <= 0:
+        return children
+    threshold = total_size * min_box_size ** 2 / (w * h)
+    large = []
+    small = []
+    for c in children:
+        if size_key(c) >= threshold:
+            large.append(c)
+        else:
+            small.append(c)
+    if len(small) < 2:
+        return children
+    # a group inside a group (zoomed in) belongs to the same directory
+    large.append(SmallFiles(node.parent if type(node) is SmallFiles else node, small))
+    return large
+
+
+class SmallFiles(object):
+    """
+    children of a directory that are too small to draw, drawn as one rect
+    labelled with their count and total size. compute_rectangles makes
+    these and puts them in the rect dict, as 'group'. laid out as the
+    top-level node they are a directory of their members, which is how
+    the tk renderer zooms into one. the path is made up (below the
+    directory, named after the count) and only names the rect.
+    """
+    __slots__ = ('parent', 'children', 'size', '_details')
+
+    kind = None
+
+    def __init__(self, parent, children):
+        self.parent = parent
+        self.children = children
+        self.size = sum(map(_bytes, children))
+        # totals of the details other size modes use
+        details = {}
+        for c in children:
+            if c._details:
+                for key in ('lines', 'growth', 'delta'):
+                    if key in c._details:
+                        details[key] = details.get(key, 0) + c._details[key]
+        self._details = details
+
+    @property
+    def details(self):
+        return self._details
+
+    @property
+    def basename(self):
+        return '%d small files' % len(self.children)
+
+    name = basename
+
+    @property
+    def path(self):
+        return os.path.join(self.parent.path, self.basename)
+
+
+# directories with at least this many children are split with numpy
+KERNEL_MIN_CHILDREN = 1000
+
+
+class _Span(object):
+    """
+    a "file group": the children nodes[lo:hi] of a directory, sorted by size
+    key, with sums[i] the total size of nodes[:i]
+    """
+    __slots__ = ('nodes', 'sums', 'lo', 'hi')
+
+    def __init__(self, nodes, sums, lo, hi):
+        self.nodes = nodes
+        self.sums = sums
+        self.lo = lo
+        self.hi = hi
+
+    @classmethod
+    def of(cls, children, size_key):
+        # sorted() leaves the tree's own children order alone
+        nodes = sorted(children, key=size_key)
+        sums = [0]
+        sums.extend(itertools.accumulate(map(size_key, nodes)))
+        return cls(nodes, sums, 0, len(nodes))
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def total(self):
+        return self.sums[self.hi] - self.sums[self.lo]
+
+
+def squarify(span, xlim, ylim, xpad, ypad, total_size):
     """core geometric subdivision algorithm
     given:
-    - a list of nodes, each with a 'size' attribute,
+    - a _Span of nodes, sorted by size
     - bounding rectangle
     do this:
-    - sort list by size
-    - split list into halves as nearly equally as possible
+    - split the span into halves as nearly equally as possible: the first
+      prefix holding at least half of total_size, found by binary search
+      over the prefix sums
     - split rectangle proportionately
       - vertically if wide
       - horizontally if tall
     - if either half has a single element, pull out of list
     """
 
-    nodes.sort(key=lambda x: x.size)
-
-    Asize = 0
-    split = 0
-    while Asize < total_size / 2:
-        Asize = Asize + nodes[split].size
-        split += 1
-    if split == len(nodes):
+    nodes, sums, lo, hi = span.nodes, span.sums, span.lo, span.hi
+    # total_size can be a directory's own size, a little off the sum of its children
+    split = min(bisect.bisect_left(sums, sums[lo] + total_size / 2, lo + 1, hi + 1), hi)
+    if split == hi:
         split -= 1
-        Asize = Asize - nodes[split].size
+    Asize = sums[split] - sums[lo]
 
     # split into two groups, append extra information
-    groupA = nodes[0:split]
-    groupB = nodes[split:]
+    groupA = _Span(nodes, sums, lo, split)
+    groupB = _Span(nodes, sums, split, hi)
 
     # figure out geometric division
     if xlim[1] - xlim[0] > ylim[1] - ylim[0]:
@@ -138,12 +496,71 @@ def squarify(nodes, xlim, ylim, xpad, ypad, total_size):
 
     # extract single element if necessary; add some graphical padding
     if len(groupA) == 1:
-        groupA = groupA[0]
+        groupA = nodes[lo]
         xA = [xA[0] + xpad, xA[1] - xpad]
         yA = [yA[0] + ypad, yA[1] - ypad]
     if len(groupB) == 1:
-        groupB = groupB[0]
+        groupB = nodes[split]
         xB = [xB[0] + xpad, xB[1] - xpad]
         yB = [yB[0] + ypad, yB[1] - ypad]
 
     return groupA, xA, yA, groupB, xB, yB
+
+
+def split_rectangles(sizes, xlim, ylim, xpad, ypad, total_size, min_box_size):
+    """
+    the boxes that repeated squarify splits give each child of a directory,
+    computed with numpy one level of splits at a time: every group at that
+    level is split in the same vectorized step.
+
+    sizes is an int array of the children's size keys, xlim/ylim the box
+    inside the directory's padding, total_size as passed to squarify. groups
+    whose box is smaller than min_box_size in either direction are dropped,
+    as compute_rectangles does. returns arrays (child index, x0, x1, y0, y1)
+    for the single-child boxes (padded), in the order compute_rectangles
+    visits them, and the long / short side ratio of the most square box
+    that was split.
+    """
+    order = np.argsort(sizes, kind='stable')
+    sums = np.zeros(len(sizes) + 1, np.int64)
+    np.cumsum(sizes[order], out=sums[1:])
+
+    # the groups still to split, as ranges lo:hi of the sorted order
+    lo = np.array([0])
+    hi = np.array([len(sizes)])
+    total = np.array([total_size], np.float64)
+    x0, x1 = np.array([float(xlim[0])]), np.array([float(xlim[1])])
+    y0, y1 = np.array([float(ylim[0])]), np.array([float(ylim[1])])
+    leaves = []
+    min_ratio = float('inf')
+    while lo.size:
+        w, h = x1 - x0, y1 - y0
+        short = np.minimum(w, h)
+        drawn = (short >= min_box_size) & (short > 0)
+        if drawn.any():
+            min_ratio = min(min_ratio, float((np.maximum(w, h)[drawn] / short[drawn]).min()))
+        split = np.minimum(np.searchsorted(sums, sums[lo] + total / 2, side='left'), hi)
+        split[split == hi] -= 1
+        asize = sums[split] - sums[lo]
+        wide = w > h
+        xdiv = x0 + w * asize / total
+        ydiv = y0 + h * asize / total
+
+        # both halves of every group: A = lo:split, then B = split:hi
+        lo, hi = np.concatenate([lo, split]), np.concatenate([split, hi])
+        total = (sums[hi] - sums[lo]).astype(np.float64)
+        x0, x1 = np.concatenate([x0, np.where(wide, xdiv, x0)]), np.concatenate([np.where(wide, xdiv, x1), x1])
+        y0, y1 = np.concatenate([y0, np.where(wide, y0, ydiv)]), np.concatenate([np.where(wide, y1, ydiv), y1])
+
+        n = hi - lo
+        single = n == 1
+        leaves.append((lo[single], x0[single] + xpad, x1[single] - xpad, y0[single] + ypad, y1[single] - ypad))
+        keep = ((n > 1) & (x1 - x0 >= min_box_size) & (y1 - y0 >= min_box_size) & (total > 0))
+        lo, hi, total = lo[keep], hi[keep], total[keep]
+        x0, x1, y0, y1 = x0[keep], x1[keep], y0[keep], y1[keep]
+
+    pos, bx0, bx1, by0, by1 = [np.concatenate(a) for a in zip(*leaves)]
+    visible = (bx1 - bx0 >= min_box_size) & (by1 - by0 >= min_box_size)
+    # a depth-first walk of the splits meets the children in sorted order
+    by_pos = np.argsort(pos[visible])
+    return tuple(a[visible][by_pos] for a in (order[pos], bx0, bx1, by0, by1)) + (min_ratio,)
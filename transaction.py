@@ -0,0 +1,144 @@
+"""
+edits to a scanned tree that keep it consistent with the disk, without a rescan
+
+    with TreeTransaction(tree) as tx:
+        tx.remove('/path/to/trashed/file')
+        tx.move('/path/to/old', '/path/to/new/parent')
+        tx.set_size('/path/to/grown/file', 12345)
+
+each operation checks that the disk agrees with it (a removed path is gone,
+a moved one is at its new place, a resized file has that size), applies the
+change, and adds the size difference to every ancestor. line counts are
+carried the same way when the tree has them, and cached aggregates of the
+ancestors are dropped. a check that fails raises TreeMismatch; leaving the
+with block by any exception undoes the operations already applied, so the
+caller can fall back to a rescan with the tree as it was.
+
+nodes are found through the name index (see DirectoryNode), so each
+operation costs time proportional to the depth of the path.
+"""
+import os
+import stat
+
+from aggregates import invalidate_stats
+from logger import logger
+from scan import FILE, node_chain
+
+
+class TreeMismatch(Exception):
+    """the tree or the disk doesn't match an edit"""
+
+
+class TreeTransaction(object):
+    def __init__(self, tree, verify=True):
+        self.tree = tree
+        # check each edit against the disk
+        self.verify = verify
+        # inverse of each applied edit, newest last
+        self._undo = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.rollback()
+        else:
+            self.commit()
+        return False
+
+    def commit(self):
+        self._undo = []
+
+    def rollback(self):
+        while self._undo:
+            self._undo.pop()()
+
+    def remove(self, path):
+        """drop the node at path, which must no longer exist on disk. returns the node"""
+        if self.verify and os.path.lexists(path):
+            raise TreeMismatch('%s still exists' % path)
+        chain = self._chain(path)
+        parent, node = chain[-2], chain[-1]
+        parent.remove_child(node)
+        self._propagate(chain[:-1], -node.size, -_lines(node))
+
+        def undo():
+            parent.add_child(node)
+            self._propagate(chain[:-1], node.size, _lines(node))
+        self._undo.append(undo)
+        return node
+
+    def move(self, path, new_parent_path):
+        """reparent the node at path below new_parent_path, keeping its name"""
+        chain = self._chain(path)
+        new_chain = self._chain(new_parent_path, allow_root=True)
+        old_parent, node = chain[-2], chain[-1]
+        new_parent = new_chain[-1]
+        if node in new_chain:
+            raise TreeMismatch('cannot move %s into itself' % path)
+        if new_parent.child(node.basename) is not None:
+            raise TreeMismatch('%s already has an entry %s' % (new_parent_path, node.basename))
+        if self.verify:
+            new_path = new_parent_path + os.sep + node.basename
+            if os.path.lexists(path) or not os.path.lexists(new_path):
+                raise TreeMismatch('%s was not moved to %s' % (path, new_path))
+
+        size, lines = node.size, _lines(node)
+        old_parent.remove_child(node)
+        self._propagate(chain[:-1], -size, -lines)
+        node.set_parent(new_parent)
+        new_parent.add_child(node)
+        self._propagate(new_chain, size, lines)
+
+        def undo():
+            new_parent.remove_child(node)
+            self._propagate(new_chain, -size, -lines)
+            node.set_parent(old_parent)
+            old_parent.add_child(node)
+            self._propagate(chain[:-1], size, lines)
+        self._undo.append(undo)
+        return node
+
+    def set_size(self, path, size):
+        """record a new size for the file at path"""
+        chain = self._chain(path)
+        node = chain[-1]
+        if node.kind != FILE:
+            raise TreeMismatch('%s is not a file' % path)
+        if self.verify:
+            try:
+                st = os.lstat(path)
+            except OSError as exc:
+                raise TreeMismatch(str(exc))
+            if not stat.S_ISREG(st.st_mode) or st.st_size != size:
+                raise TreeMismatch('%s is not %d bytes on disk' % (path, size))
+        old_size = node.size
+        node.size = size
+        self._propagate(chain[:-1], size - old_size, 0)
+
+        def undo():
+            node.size = old_size
+            self._propagate(chain[:-1], old_size - size, 0)
+        self._undo.append(undo)
+        return node
+
+    def _chain(self, path, allow_root=False):
+        chain = node_chain(self.tree, path.rstrip(os.sep) or os.sep)
+        if chain is None:
+            raise TreeMismatch('%s is not in the tree' % path)
+        if len(chain) < 2 and not allow_root:
+            raise TreeMismatch('cannot edit the root %s' % path)
+        return chain
+
+    def _propagate(self, ancestors, size_delta, lines_delta):
+        for node in ancestors:
+            node.size += size_delta
+            if lines_delta and 'lines' in node.details:
+                node.details['lines'] += lines_delta
+        invalidate_stats(ancestors)
+        logger.trace('tree edit: %+d bytes on %d ancestors' % (size_delta, len(ancestors)))
+
+
+def _lines(node):
+    return node.details.get('lines', 0)
@@ -3,11 +3,25 @@
 treemonger [options] [path]
 path:     optional, defaults to PWD
 options:  optional
-- --exclude-dir=dirname  OR  -d=dirname  # exclude directory by name
+- --exclude-dir=dirname  OR  -d=dirname  # exclude directory by name, or by path if it contains a separator
 - --exclude-file=filename                # exclude file by name
 - --exclude-filter=filter                # exclude file by substring match
-- --file=pth                             # load previous scan from file
+- --exclude-pattern=pattern              # exclude by .gitignore-style pattern
+- --exclude-from=path                    # read .gitignore-style patterns from a file
+- --file=pth                             # load previous scan from an archive (binary, or json from older versions)
 - --file                                 # automatically load most recent scan from PWD
+- --diff=pth                             # show what changed since an archived scan: rects sized by bytes changed
+- --diff                                 # same, against the most recent archived scan of this path
+- --store                                # also save the scan as a sqlite database, for query.py
+- --list-archives[=path]                 # list archived scans (of one path) from the catalog, and exit
+- --scan-threads=N                       # walk directories with N threads
+- --time-budget=SEC                      # approximate scan: stop after SEC seconds, estimate the rest
+- --entry-budget=N                       # approximate scan: stop after N entries, estimate the rest
+- --size-mode=lines                      # size rectangles by text line count instead of bytes
+- --columnar                             # store the tree in numpy arrays instead of one object per entry
+- --journal                              # record the scan in a journal as it goes, so it can be resumed
+- --resume                               # resume an interrupted --journal scan of the same path
+- --watch  OR  -w                        # keep the treemap current as files change
 
 
 """
@@ -21,10 +35,20 @@ import pathlib
 import socket
 import sys
 
+from aggregates import aggregates
+from archive import DEFAULT_MAX_NODES, open_archive, save_archive
+from catalog import Catalog
+from columnar import numpy_present, scan_columnar
+from diff import diff_trees
+from exclude import load_patterns
+from journal import scan_directory_tree_journaled
+from linecount import add_line_counts
 from logger import logger, set_verbosity
 from utils import format_bytes
-from scan import get_directory_tree, print_directory_tree, tree_to_dict, dict_to_tree
-from subdivide import compute_rectangles
+from scan import scan_directory_tree, scan_directory_tree_parallel, scan_directory_tree_budgeted, rescan_directory_tree, print_directory_tree
+from store import is_store, load_store, save_store
+from subdivide import DEFAULT_MAX_CACHED_RECTS, LayoutEngine
+from watch import create_watcher
 from renderers import tk as tk_renderer
 from renderers import svg_basic
 
@@ -33,7 +57,6 @@ from renderers import svg_basic
 # - text rendering (renderers.tk.TreemongerApp.render_rect()):
 #   - make clipping better
 #   - scale text to fill rectangle more, so bigger files have bigger text
-# - size rectangles by text linecount
 # - "restore this file" after moving to trash
 # - undo move-to-trash actions
 # - show hover info in status bar
@@ -74,7 +97,7 @@ def main(args):
         if cli_flags.get(k, []) == []:
             continue
         if type(v) is list:
-            flags[k].extend(cli_flags[k])
+            flags.setdefault(k, []).extend(cli_flags[k])
         else:
             flags[k] = cli_flags[k]
 
@@ -87,40 +110,68 @@ def main(args):
     # logger.debug(f"full flags: %s" % json.dumps(flags, indent=2))
 
 
-    if 'file' in flags:
-        
-        def scan_func():
-            with open(flags['file'], 'r') as f:
-                data = json.load(f)
-            root = data['root']
-            t = dict_to_tree(data['tree'])
-            logger.info(f'loaded scan from file "{flags['file']}"')
-            save_to_archive = False
-            return t
-    else:
-        def scan_func():
-            t0 = dt.now()
-            t = get_directory_tree(
-                root,
-                exclude_dirs=flags['exclude-dirs'],
-                exclude_files=flags['exclude-files'],
-                exclude_filters=flags['exclude-filters'],
-                skip_mount=flags['skip-mount'],
-            )
-            t1 = dt.now()
-
-            delta_t = (t1 - t0).seconds + (t1 - t0).microseconds/1e6
-            logger.info('%f sec to scan %s / %s files' %
-                (delta_t, format_bytes(t.size), get_total_children(t)))
-            return t
+    exclude_patterns = list(flags.get('exclude-patterns', []))
+    for fname in flags.get('exclude-from', []):
+        exclude_patterns.extend(load_patterns(fname))
+    scan_kwargs = dict(
+        exclude_dirs=flags['exclude-dirs'],
+        exclude_files=flags['exclude-files'],
+        exclude_filters=flags['exclude-filters'],
+        exclude_patterns=exclude_patterns,
+        exclude_root=root,
+        skip_mount=flags['skip-mount'],
+    )
+    watch_func = None
+
+    # the lines size mode needs a line count for every file, right after the scan
+    if 'size-mode' in flags:
+        config['tk_renderer']['size_mode'] = flags['size-mode']
+        config['svg-renderer']['size_mode'] = flags['size-mode']
+    count_lines = 'lines' in (config['tk_renderer']['size_mode'], config['svg-renderer']['size_mode'])
+
+    columnar = flags.get('columnar', False)
+    if columnar and not numpy_present:
+        logger.warning('--columnar needs numpy, falling back to the default tree store')
+        columnar = False
 
     realroot = os.path.realpath(root)
     archive_filename = expand_filename_pattern(flags.get('archive-name-pattern', ''), realroot, HOST, NOW)
 
     archive_path = os.path.dirname(archive_filename)
+    # no timestamp in the default pattern: --resume has to find the journal of the earlier run
+    journal_filename = expand_filename_pattern(flags.get('journal-pattern', ''), realroot, HOST, NOW)
+    journal = flags.get('journal', False) and journal_filename
+    if flags.get('journal', False) and not journal_filename:
+        logger.warning('--journal needs a journal-pattern in the config, scanning without one')
+
+    catalog_filename = os.path.expanduser(flags.get('archive-catalog', ''))
+
+    if 'list-archives' in flags:
+        list_archives(catalog_filename, flags['list-archives'])
+        return
+
+    def latest_archive():
+        fname = ''
+        if catalog_filename:
+            with Catalog(catalog_filename) as catalog:
+                fname = catalog.latest(HOST, realroot)
+        if not fname:
+            # archives saved before the catalog existed
+            fname = get_latest_file_for_pwd(archive_path)
+        return fname
+
+    # resolved before scanning: this run's own archive must not be the baseline
+    diff_filename = flags.get('diff') or (latest_archive() if flags.get('diff-latest') else '')
+    if diff_filename:
+        logger.info('diffing against %s' % diff_filename)
+        if 'size-mode' not in flags:
+            config['tk_renderer']['size_mode'] = 'growth'
+            config['svg-renderer']['size_mode'] = 'growth'
+    elif flags.get('diff-latest'):
+        logger.warning('--diff: no archived scan of %s found' % realroot)
 
     if flags.get('file-latest', False):
-        fname = get_latest_file_for_pwd(archive_path)
+        fname = latest_archive()
         ts = os.stat(fname).st_mtime
         ts_dt = datetime.datetime.fromtimestamp(ts)
         ts_str = ts_dt.strftime('%Y-%m-%d %H:%M:%S')
@@ -128,25 +179,128 @@ def main(args):
         logger.info('using latest recorded file (%s): %s' % (ts_str, fname))
         flags['file'] = fname
 
-    logger.info('skipping archive during refactor')
-    # if not config.flags.get('file', False) and config.flags['save-to-archive']:
-    #     data = {
-    #         'tree': tree_to_dict(t),
-    #         'root': realroot,
-    #         'host': HOST,
-    #         'options': flags,
-    #         'scan_timestamp': NOW,
-    #         'scan_duration_seconds': delta_t,
-    #     }
-
-    #     logger.info('archiving results to:\n  %s' % archive_filename)
-    #     try:
-    #         if not os.path.exists(archive_path):
-    #             os.mkdir(archive_path)
-    #         with open(archive_filename, 'w') as f:
-    #             json.dump(data, f)
-    #     except Exception as exc:
-    #         logger.error(exc)
+    def scan_metadata(delta_t):
+        return {
+            'root': realroot,
+            'host': HOST,
+            'options': flags,
+            'scan_timestamp': NOW,
+            'scan_duration_seconds': delta_t,
+        }
+
+    def save_scan(t, delta_t):
+        metadata = scan_metadata(delta_t)
+        logger.info('archiving results to:\n  %s' % archive_filename)
+        try:
+            os.makedirs(archive_path, exist_ok=True)
+            save_archive(archive_filename, t, metadata,
+                         compression=flags.get('archive-compression') or None,
+                         fmt=flags.get('archive-format', 'binary'))
+            if catalog_filename:
+                with Catalog(catalog_filename) as catalog:
+                    catalog.add(archive_filename, HOST, realroot, NOW, delta_t, t.size, aggregates(t).files)
+        except Exception as exc:
+            logger.error(exc)
+
+    def save_scan_store(t, delta_t):
+        store_filename = expand_filename_pattern(flags.get('store-name-pattern', ''), realroot, HOST, NOW)
+        if not store_filename:
+            logger.warning('--store needs a store-name-pattern in the config')
+            return
+        logger.info('saving scan store to:\n  %s' % store_filename)
+        try:
+            os.makedirs(os.path.dirname(store_filename), exist_ok=True)
+            save_store(store_filename, t, scan_metadata(delta_t))
+        except Exception as exc:
+            logger.error(exc)
+
+    if 'file' in flags and is_store(flags['file']):
+        def scan_func(tree=None, progress=None):
+            t, metadata = load_store(flags['file'])
+            logger.info('loaded scan of %s from store "%s"' % (metadata.get('root'), flags['file']))
+            return t
+    elif 'file' in flags:
+        def scan_func(tree=None, progress=None):
+            # directories are read from the archive as the view reaches them
+            t, metadata = open_archive(flags['file'], max_nodes=flags.get('archive-max-nodes', DEFAULT_MAX_NODES))
+            logger.info('loaded scan of %s from file "%s"' % (metadata.get('root'), flags['file']))
+            return t
+    else:
+        # the archive and store names carry this run's start time (NOW)
+        saved = False
+
+        def scan_func(tree=None, progress=None):
+            # pass the previous tree to only rescan directories that changed,
+            # or a ScanProgress to follow a scan running on another thread
+            nonlocal saved
+            t0 = dt.now()
+            threads = flags.get('scan-threads', 1)
+            time_budget = flags.get('time-budget')
+            entry_budget = flags.get('entry-budget')
+            if columnar:
+                # no partial tree or incremental rescan for the columnar store,
+                # the arrays are built whole
+                t = scan_columnar(root, **scan_kwargs).root()
+            elif tree is not None:
+                t = rescan_directory_tree(tree, file_keys=count_lines, **scan_kwargs)
+            elif time_budget or entry_budget:
+                logger.info('approximate scan, budget: %s sec / %s entries' % (time_budget, entry_budget))
+                t = scan_directory_tree_budgeted(root, progress=progress, time_budget=time_budget,
+                                                 entry_budget=entry_budget, file_keys=count_lines,
+                                                 **scan_kwargs)
+            elif journal:
+                t = scan_directory_tree_journaled(root, journal_filename, resume=flags.get('resume', False),
+                                                  progress=progress, file_keys=count_lines, **scan_kwargs)
+            elif threads > 1:
+                logger.info('scanning with %d threads' % threads)
+                t = scan_directory_tree_parallel(root, threads=threads, progress=progress,
+                                                 file_keys=count_lines, **scan_kwargs)
+            else:
+                t = scan_directory_tree(root, progress=progress, file_keys=count_lines, **scan_kwargs)
+            t1 = dt.now()
+
+            delta_t = (t1 - t0).seconds + (t1 - t0).microseconds/1e6
+            logger.info('%f sec to scan %s' % (delta_t, format_bytes(t.size)))
+
+            if count_lines:
+                if progress:
+                    progress.stage = 'Counting lines'
+                add_line_counts(t, flags.get('line-count-cache'))
+
+            if saved:
+                # a refresh or full rescan (shift+r) would overwrite this run's files
+                return t
+            saved = True
+            # progress.finish() only clears the root's in_progress mark after
+            # this returns; the saved files must not carry it
+            in_progress = t.details.pop('in_progress', None)
+            if flags.get('save-to-archive') and archive_filename:
+                save_scan(t, delta_t)
+            if flags.get('save-to-store'):
+                save_scan_store(t, delta_t)
+            if in_progress:
+                t.details['in_progress'] = in_progress
+            return t
+
+        if flags.get('watch', False) and columnar:
+            logger.warning('--watch is not supported with --columnar')
+        elif flags.get('watch', False):
+            def watch_func(tree):
+                return create_watcher(tree, flags.get('watch-poll-interval', 5.0), **scan_kwargs)
+
+    if diff_filename:
+        base_scan_func = scan_func
+
+        def scan_func(tree=None, progress=None):
+            # a refresh diffs a full new scan: the diff tree can't be rescanned in place
+            new = base_scan_func(None, progress)
+            old, metadata = open_archive(diff_filename, max_nodes=flags.get('archive-max-nodes', DEFAULT_MAX_NODES))
+            logger.info('diffing against scan of %s from %s' % (metadata.get('root'), metadata.get('scan_timestamp')))
+            return diff_trees(old, new)
+
+        if watch_func is not None:
+            logger.warning('--watch is not supported with --diff')
+            watch_func = None
 
     trash_log_pattern = flags.get('trash-log-pattern', None)
     if trash_log_pattern:
@@ -155,15 +309,16 @@ def main(args):
         os.makedirs(trash_path, exist_ok=True)
 
     # one run can invoke multiple renderers, e.g. write file and display app
+    layout = LayoutEngine(config['tk_renderer'].get('layout_cache_rects', DEFAULT_MAX_CACHED_RECTS))
     if 'svg-basic' in flags['renderer']:
         logger.info('starting svg-basic renderer')
         config['svg-renderer']['filename'] = expand_filename_pattern(config['svg-renderer']['filename-pattern'], realroot, HOST, NOW)
-        svg_basic.render(scan_func, compute_rectangles, config)
+        svg_basic.render(scan_func, layout, config)
 
     if 'tk' in flags['renderer']:
         logger.info('starting tk renderer')
         title = os.path.realpath(root)
-        tk_renderer.init_app(scan_func, compute_rectangles, config, title=title)
+        tk_renderer.init_app(scan_func, layout, config, title=title, watch_func=watch_func)
 
 
 def expand_filename_pattern(pattern, rootpath, host, timestamp):
@@ -183,13 +338,6 @@ def expand_filename_pattern(pattern, rootpath, host, timestamp):
     return fname
 
 
-def get_total_children(t):
-    if t.children:
-        return sum([get_total_children(c) for c in t.children])
-    else:
-        return 1
-
-
 def parse_config_file():
     logger.info('loading config from %s' % config_file_path)
     with open(config_file_path) as f:
@@ -204,6 +352,8 @@ def parse_args(args):
         'exclude-dirs': [],
         'exclude-files': [],
         'exclude-filters': [],
+        'exclude-patterns': [],
+        'exclude-from': [],
         'renderer': [],
     }
 
@@ -222,12 +372,43 @@ def parse_args(args):
                 cli_flags['exclude-files'].append(arg.split('=')[1])
             if arg.startswith('--exclude-filter='):
                 cli_flags['exclude-filters'].append(arg.split('=')[1])
+            if arg.startswith('--exclude-pattern='):
+                cli_flags['exclude-patterns'].append(arg.split('=', 1)[1])
+            if arg.startswith('--exclude-from='):
+                cli_flags['exclude-from'].append(os.path.expanduser(arg.split('=', 1)[1]))
+            if arg.startswith('--list-archives'):
+                # optionally restricted to one root
+                cli_flags['list-archives'] = os.path.realpath(os.path.expanduser(arg.split('=', 1)[1])) if '=' in arg else None
+            if arg.startswith('--diff'):
+                if '=' in arg:
+                    cli_flags['diff'] = os.path.expanduser(arg.split('=', 1)[1])
+                else:
+                    cli_flags['diff-latest'] = True
             if arg.startswith('--file') or arg.startswith('-f'):
                 if '=' in arg:
                     cli_flags['file'] = os.path.expanduser(arg.split('=')[1])
                 else:
                     cli_flags['file-latest'] = True
                     logger.debug('set file-latest = true')
+            if arg == '--store':
+                cli_flags['save-to-store'] = True
+            if arg == '--columnar':
+                cli_flags['columnar'] = True
+            if arg == '--journal':
+                cli_flags['journal'] = True
+            if arg == '--resume':
+                cli_flags['journal'] = True
+                cli_flags['resume'] = True
+            if arg == '--watch' or arg == '-w':
+                cli_flags['watch'] = True
+            if arg.startswith('--size-mode='):
+                cli_flags['size-mode'] = arg.split('=')[1]
+            if arg.startswith('--time-budget='):
+                cli_flags['time-budget'] = float(arg.split('=')[1])
+            if arg.startswith('--entry-budget='):
+                cli_flags['entry-budget'] = int(arg.split('=')[1])
+            if arg.startswith('--scan-threads='):
+                cli_flags['scan-threads'] = int(arg.split('=')[1])
             if arg.startswith('--skip-mount') or arg == '-x':
                 if 'false' in arg.lower():
                     cli_flags['skip-mount'] = False
@@ -246,6 +427,20 @@ def parse_args(args):
     return root, cli_flags
 
 
+def list_archives(catalog_filename, root=None):
+    if not catalog_filename:
+        logger.error('no archive-catalog set in the config')
+        return
+    with Catalog(catalog_filename) as catalog:
+        rows = catalog.archives(root=root)
+    for row in rows:
+        print('%s  %-12s %10s %10s files %8.1f sec  %s\n    %s' % (
+            row['timestamp'], row['host'], format_bytes(row['size'] or 0), row['files'],
+            row['duration'] or 0, row['root'], row['path']))
+    if not rows:
+        print('no archives in %s' % catalog_filename)
+
+
 def get_latest_file_for_pwd(archive_path):
     glb = glob.glob(archive_path + '/*')
     if glb:
@@ -0,0 +1,227 @@
+"""
+keep a scanned tree current while the app is open
+
+on linux, changes are picked up from inotify (through ctypes, no extra
+dependencies); elsewhere, or if inotify can't be initialized, the tree is
+periodically refreshed with rescan_directory_tree instead.
+
+watchers never touch the tree on their own: the app calls poll() from its
+event loop, which drains everything that happened since the previous call
+and applies it in one batch.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import struct
+import time
+
+from aggregates import invalidate_stats
+from logger import logger
+from scan import FILE, DirectoryNode, ScanOptions, node_chain, rescan_directory_tree, scan_directory_tree
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_event_header = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def create_watcher(tree, poll_interval=5.0, **scan_kwargs):
+    """inotify watcher if available, otherwise a polling one"""
+    try:
+        return InotifyWatcher(tree, **scan_kwargs)
+    except OSError as exc:
+        logger.info('inotify not available (%s), polling every %.1fs' % (exc, poll_interval))
+        return PollingWatcher(tree, poll_interval, **scan_kwargs)
+
+
+class InotifyWatcher(object):
+    def __init__(self, tree, **scan_kwargs):
+        self.tree = tree
+        self.scan_kwargs = scan_kwargs
+        self.opts = ScanOptions(**scan_kwargs)
+        self.wds = {}  # watch descriptor -> directory path
+        self._limit_reached = False
+
+        libname = ctypes.util.find_library('c')
+        if libname is None:
+            raise OSError('libc not found')
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('libc has no inotify')
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        t0 = time.time()
+        self._watch_tree(tree)
+        logger.info('watching %d directories (%.3f sec)' % (len(self.wds), time.time() - t0))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def poll(self):
+        """apply pending filesystem events to the tree. returns True if it changed."""
+        # collapse the batch to one reconcile per entry: repeated writes to the
+        # same file, or a create followed by a delete, cost a single lstat
+        dirty = {}
+        overflow = False
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+            elif name and wd in self.wds:
+                dirty[(self.wds[wd], name)] = True
+
+        if overflow:
+            # events were dropped, compare directory mtimes instead
+            logger.warning('inotify queue overflowed, refreshing changed directories')
+            self.tree = rescan_directory_tree(self.tree, **self.scan_kwargs)
+            self._watch_tree(self.tree)
+            return True
+
+        changed = False
+        for dirpath, name in dirty:
+            changed |= self._reconcile(dirpath, name)
+        return changed
+
+    def _read_events(self):
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = _event_header.unpack_from(buf, pos)
+                pos += _event_header.size
+                name = buf[pos:pos + length].rstrip(b'\0')
+                pos += length
+                events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def _watch_tree(self, t):
+        stack = [t]
+        while stack:
+            node = stack.pop()
+            if node.inode is None or 'skip' in node.details:
+                # files, and directories that were never listed
+                continue
+            self._add_watch(node.path)
+            stack.extend(node.children)
+
+    def _add_watch(self, path):
+        if self._limit_reached:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self._limit_reached = True
+                logger.warning('inotify watch limit reached at %d directories, raise '
+                               'fs.inotify.max_user_watches to watch the whole tree' % len(self.wds))
+            elif err != errno.ENOENT:
+                logger.debug('inotify_add_watch failed for %s: %s' % (path, os.strerror(err)))
+            return
+        self.wds[wd] = path
+
+    def _reconcile(self, dirpath, name):
+        """make the tree entry for dirpath/name match the disk. returns True if it changed."""
+        chain = node_chain(self.tree, dirpath)
+        if chain is None:
+            # parent was removed or never scanned
+            return False
+        parent = chain[-1]
+        path = dirpath + os.sep + name
+        existing = parent.child(name)
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            st = None
+
+        if st is None:
+            if existing is None:
+                return False
+            logger.debug('watch: removed %s' % path)
+            parent.remove_child(existing)
+            delta = -existing.size
+        elif (existing is not None and stat.S_ISDIR(st.st_mode) and
+              existing.inode == st.st_ino):
+            # same directory, its contents are reported by its own watch
+            return False
+        elif (existing is not None and stat.S_ISREG(st.st_mode) and
+              existing.kind == FILE and 'skip' not in existing.details):
+            if existing.size == st.st_size:
+                return False
+            delta = st.st_size - existing.size
+            existing.size = st.st_size
+        else:
+            # new entry, or an existing one that changed type
+            rules = self.opts.rules
+            is_dir = stat.S_ISDIR(st.st_mode)
+            real_prefix = ''
+            if rules:
+                real_prefix = os.path.realpath(dirpath).rstrip(os.sep) + os.sep
+                if rules.excluded(name, real_prefix, is_dir):
+                    return False
+            logger.debug('watch: added %s' % path)
+            if rules and is_dir and rules.dir_excluded(name, real_prefix + name):
+                node = DirectoryNode(name, 0, parent)
+                node.details['skip'] = 'exclude_dir'
+            else:
+                node = scan_directory_tree(path, **self.scan_kwargs)
+                node.set_parent(parent)
+            if existing is None:
+                parent.add_child(node)
+                delta = node.size
+            else:
+                parent.replace_child(existing, node)
+                delta = node.size - existing.size
+            self._watch_tree(node)
+
+        for node in chain:
+            node.size += delta
+        invalidate_stats(chain)
+        return True
+
+
+class PollingWatcher(object):
+    def __init__(self, tree, interval=5.0, **scan_kwargs):
+        self.tree = tree
+        self.interval = interval
+        self.scan_kwargs = scan_kwargs
+        self._last_poll = time.time()
+
+    def close(self):
+        pass
+
+    def poll(self):
+        now = time.time()
+        if now - self._last_poll < self.interval:
+            return False
+        self._last_poll = now
+        size = self.tree.size
+        tree = rescan_directory_tree(self.tree, **self.scan_kwargs)
+        changed = tree is not self.tree or tree.size != size
+        self.tree = tree
+        return changed